@@ -57,6 +57,10 @@ from taskmaster import TaskMaster
 from graphics import Graphics, FONT_SIZES
 from helppanel import HelpPanel
 import utils
+import trainingdata
+from volumes import VolumeRegistry
+from ioworker import IOWorker
+from usbwatch import USBWatcher
 from power import get_power_manager
 
 import logging
@@ -99,6 +103,7 @@ class TrainingActivity(activity.Activity):
     transfer_progressed_signal = GObject.Signal('progressed', arg_types=([]))
     transfer_completed_signal = GObject.Signal('completed', arg_types=([]))
     transfer_failed_signal = GObject.Signal('failed', arg_types=([]))
+    transfer_queued_signal = GObject.Signal('queued', arg_types=([int]))
 
     def __init__(self, handle):
         ''' Initialize the toolbars and restore any saved data '''
@@ -112,6 +117,7 @@ class TrainingActivity(activity.Activity):
         self.connect('progressed', self.__transfer_progressed_cb)
         self.connect('completed', self.__transfer_completed_cb)
         self.connect('failed', self.__transfer_failed_cb)
+        self.connect('queued', self.__transfer_queued_cb)
 
         self.volume_monitor = Gio.VolumeMonitor.get()
         self._mount_added_id = self.volume_monitor.connect(
@@ -134,6 +140,13 @@ class TrainingActivity(activity.Activity):
 
         self.bundle_path = activity.get_bundle_path()
         self.volume_data = []
+        self._volumes = VolumeRegistry()
+        # The files on the USB key, for the tests
+        self.usb_watcher = USBWatcher()
+        # Training-data I/O is done on a thread of its own
+        self.io = IOWorker()
+        # The registry serial number as of the last successful volume check
+        self._volume_check_serial = None
         self._selected_volume = None
         self._saved_uid = None
         self._new_session = False
@@ -147,6 +160,10 @@ class TrainingActivity(activity.Activity):
         self._fixed = None
         self._fatal_error = False
         self._notify_transfer_status = False
+        # The icon and tooltip of the transfer button, and the number of
+        # reports waiting to be sent (shown in the tooltip)
+        self._transfer_status = ('transfer', _('Training data upload status'))
+        self._transfer_queue_depth = 0
 
         if self.check_volume_data():
             if self.volume_data[0]['uid'] is not None:
@@ -171,6 +188,11 @@ class TrainingActivity(activity.Activity):
 
     def can_close(self):
         get_power_manager().restore_suspend()
+        # We may have failed before getting to init of taskmaster
+        if hasattr(self, '_task_master'):
+            self._task_master.flush_task_data()
+            self._task_master.save_task_data_header()
+        self.io.wait()
         return True
 
     def busy_cursor(self):
@@ -192,15 +214,17 @@ class TrainingActivity(activity.Activity):
                           'so shutting down instead of checking volume data.')
             self.close()
 
-        _logger.debug(utils.get_volume_paths())
+        # Nothing has changed since the last time the check passed.
+        if self._volume_check_serial == self._volumes.serial:
+            return True
+        self._volume_check_serial = None
+
         self.volume_data = []
-        for path in utils.get_volume_paths():
-            os.path.basename(path)
-            self.volume_data.append(
-                {'basename': os.path.basename(path),
-                 'files': utils.look_for_training_data(path),
-                 'sugar_path': os.path.join(self.get_activity_root(), 'data'),
-                 'usb_path': path})
+        for volume in self._volumes.get_volumes():
+            volume = dict(volume)
+            volume['sugar_path'] = os.path.join(self.get_activity_root(),
+                                                'data')
+            self.volume_data.append(volume)
             _logger.debug(self.volume_data[-1])
 
         # (1) We require a USB key
@@ -276,15 +300,17 @@ class TrainingActivity(activity.Activity):
             volume['uid'] = basename + TRAINING_SUFFIX
             _logger.debug('No training data found. Using UID %s' %
                           volume['uid'])
+            self._volume_check_serial = self._volumes.serial
             return True
         elif len(volume['files']) == 1:
             _logger.debug('1 FILE FOUND')
             volume['uid'] = utils.check_volume_suffix(volume['files'][0])
             # In case we renamed the files, rescan
-            volume['files'] = utils.look_for_training_data(path)
+            volume['files'] = self._volumes.rescan_files(volume['usb_path'])
             _logger.debug(volume['files'])
             _logger.debug('Training data found. Using UID %s' %
                           volume['uid'])
+            self._volume_check_serial = self._volumes.serial
             return True
         else:
             _logger.error('MULTIPLE TRAINING-DATA FILES FOUND.')
@@ -295,6 +321,7 @@ class TrainingActivity(activity.Activity):
                 if os.path.join(volume['usb_path'],
                                 self._saved_uid) in volume['files']:
                     volume['uid'] = self._saved_uid
+                    self._volume_check_serial = self._volumes.serial
                     return True
                 else:
                     # FIXME: need better feedback to the user here
@@ -310,10 +337,12 @@ class TrainingActivity(activity.Activity):
             name_list = []
             for file_name in volume['files']:
                 path = os.path.join(volume['usb_path'], file_name)
-                email_list.append(utils.get_email_from_training_data(path))
-                completed_list.append(
-                    utils.get_completed_from_training_data(path))
-                name_list.append(utils.get_name_from_training_data(path))
+                header = utils.get_training_data_header(path)
+                if header is None:
+                    header = {'email': None, 'completed': None, 'name': None}
+                email_list.append(header['email'])
+                completed_list.append(header['completed'])
+                name_list.append(header['name'])
             emails_match = True
             for email in email_list:
                 if email != email_list[0]:
@@ -333,6 +362,7 @@ class TrainingActivity(activity.Activity):
                 volume['uid'] = utils.check_volume_suffix(
                     volume['files'][max_index])
                 self._saved_uid = volume['uid']
+                self._volume_check_serial = self._volumes.serial
                 return True
 
             # If the email address is set and is *not* the same in all
@@ -432,19 +462,21 @@ class TrainingActivity(activity.Activity):
             data = {}
             data[TRAINING_DATA_UID] = self.volume_data[0]['uid']
             data[VERSION_NUMBER] = self.get_activity_version()
-            json_data = json.dumps(data)
 
             write_failed = False
             usb_data_path = os.path.join(self.volume_data[0]['usb_path'],
                                          self.volume_data[0]['uid'])
             try:
-                fd = open(usb_data_path, 'w')
-                fd.write(json_data)
-                fd.close()
+                self.io.call(trainingdata.save, usb_data_path, data)
             except Exception, e:
                 write_failed = True
                 _logger.error('Could not write to USB %s: %s' %
                               (usb_data_path, e))
+            else:
+                # The registry must know about the new file, or the next
+                # volume check will not find the uid we saved.
+                self.volume_data[0]['files'] = self._volumes.rescan_files(
+                    self.volume_data[0]['usb_path'])
             if write_failed:
                 alert = NotifyAlert()
                 alert.props.title = _('Could not launch new session.')
@@ -493,13 +525,13 @@ class TrainingActivity(activity.Activity):
 
         if usb_data_path is not None:
             usb_data = {}
+            usb_valid = False
             if os.path.exists(usb_data_path):
-                fd = open(usb_data_path, 'r')
-                json_data = fd.read()
-                fd.close()
+                json_data = self.io.call(trainingdata.read, usb_data_path)
                 if len(json_data) > 0:
                     try:
-                        usb_data = json.loads(json_data)
+                        usb_data = trainingdata.loads(json_data)[0]
+                        usb_valid = True
                     except ValueError as e:
                         _logger.error('Cannot load USB data: %s' % e)
             else:
@@ -509,19 +541,20 @@ class TrainingActivity(activity.Activity):
                 self.volume_data[0]['sugar_path'],
                 self.volume_data[0]['uid'])
             sugar_data = {}
+            sugar_valid = False
             if os.path.exists(sugar_data_path):
-                fd = open(sugar_data_path, 'r')
-                json_data = fd.read()
-                fd.close()
+                json_data = self.io.call(trainingdata.read, sugar_data_path)
                 if len(json_data) > 0:
                     try:
-                        sugar_data = json.loads(json_data)
+                        sugar_data = trainingdata.loads(json_data)[0]
+                        sugar_valid = True
                     except ValueError as e:
                         _logger.error('Cannot load Sugar data: %s' % e)
             else:
                 _logger.error('Cannot find Sugar data: %s' % sugar_data_path)
 
             # First, check to make sure email_address matches
+            email_changed = False
             if EMAIL_UID in usb_data:
                 usb_email = usb_data[EMAIL_UID]
             else:
@@ -535,10 +568,12 @@ class TrainingActivity(activity.Activity):
                     _logger.warning('Using email address from Sugar: %s' %
                                     sugar_email)
                     usb_data[EMAIL_UID] = sugar_email
+                    email_changed = True
                 elif usb_email is not None and sugar_email is None:
                     _logger.warning('Using email address from USB: %s' %
                                     usb_email)
                     sugar_data[EMAIL_UID] = usb_email
+                    email_changed = True
                 elif usb_email is None and sugar_email is None:
                     _logger.warning('No email address found')
                 else:
@@ -553,106 +588,212 @@ class TrainingActivity(activity.Activity):
                     self._load_intro_graphics(message=alert.props.msg)
                     return False
 
-            def count_completed(data):
-                count = 0
-                for key in data:
-                    if isinstance(data[key], dict) and \
-                       'completed' in data[key] and \
-                       data[key]['completed']:
-                        count += 1
-                return count
-
-            # The database with the most completed tasks takes precedence.
-            if count_completed(usb_data) >= count_completed(sugar_data):
-                _logger.debug('data sync: USB data takes precedence')
+            usb_generation = None
+            if usb_valid and trainingdata.GENERATION in usb_data:
+                usb_generation = usb_data[trainingdata.GENERATION]
+            sugar_generation = None
+            if sugar_valid and trainingdata.GENERATION in sugar_data:
+                sugar_generation = sugar_data[trainingdata.GENERATION]
+
+            # Recovery: if the copies carry generation counters, the newest
+            # valid copy wins, or, if both copies are valid, only the keys
+            # that differ are exchanged. Only older data files need the full
+            # merge. (The counters only count the commits to each copy, so
+            # equal counters do not mean equal contents.)
+            data_one = None
+            if usb_generation is not None and sugar_generation is not None:
+                if usb_data == sugar_data and not email_changed:
+                    _logger.debug('data sync: USB and Sugar data match')
+                    return True
+                elif trainingdata.MODIFIED in usb_data and \
+                     trainingdata.MODIFIED in sugar_data:
+                    # The exchange copies a missing email address itself.
+                    if email_changed and usb_email is None:
+                        del usb_data[EMAIL_UID]
+                    elif email_changed:
+                        del sugar_data[EMAIL_UID]
+                    return self._exchange_changes(usb_data_path, usb_data,
+                                                  sugar_data_path, sugar_data)
+                elif usb_generation >= sugar_generation:
+                    data_one = usb_data
+                else:
+                    data_one = sugar_data
+            elif usb_generation is not None and not sugar_valid:
                 data_one = usb_data
-                data_two = sugar_data
-            else:
-                _logger.debug('data sync: Sugar data takes precedence')
+            elif sugar_generation is not None and not usb_valid:
                 data_one = sugar_data
-                data_two = usb_data
 
-            # Copy completed tasks from one to two
-            for key in data_one:
-                if isinstance(data_one[key], dict) and \
-                   'completed' in data_one[key] and \
-                   data_one[key]['completed']:
-                    data_two[key] = data_one[key]
+            if data_one is None:
+                data_one = self._merge_data(usb_data, sugar_data)
+            else:
+                _logger.debug('data sync: using generation %d' %
+                              trainingdata.get_generation(data_one))
 
-            # Copy completed tasks from two to one
-            for key in data_two:
-                if isinstance(data_two[key], dict) and \
-                   'completed' in data_two[key] and \
-                   data_two[key]['completed']:
-                    data_one[key] = data_two[key]
+            data_one[trainingdata.GENERATION] = max(
+                trainingdata.get_generation(usb_data),
+                trainingdata.get_generation(sugar_data)) + 1
 
-            # Copy incompleted tasks from one to two
-            for key in data_one:
-                if isinstance(data_one[key], dict) and \
-                   (not 'completed' in data_one[key] or
-                    not data_one[key]['completed']):
-                        data_two[key] = data_one[key]
-
-            # Copy incompleted tasks from two to one
-            for key in data_two:
-                if isinstance(data_two[key], dict) and \
-                   (not 'completed' in data_two[key] or
-                    not data_two[key]['completed']):
-                        data_one[key] = data_two[key]
-
-            # Copy name, email_address, current_task...
-            for key in data_one:
-                if not isinstance(data_one[key], dict):
-                    data_two[key] = data_one[key]
-            for key in data_two:
-                if not isinstance(data_two[key], dict):
-                    data_one[key] = data_two[key]
-
-            # Finally, write to the USB and ...
-            json_data = json.dumps(data_one)
+            # Finally, write to the USB (compacting any log) and ...
             try:
-                fd = open(usb_data_path, 'w')
-                fd.write(json_data)
-                fd.close()
+                self.io.call(trainingdata.save, usb_data_path, data_one)
             except Exception, e:
-                self._fatal_error = True
-                _logger.error('Fatal error: could not write to %s: %s' %
-                              (usb_data_path, e))
-
-                # Don't try remounting since we are going to close.
-                self.volume_monitor.disconnect(self._mount_added_id)
-                self.volume_monitor.disconnect(self._mount_removed_id)
-
-                alert = ConfirmationAlert()
-                alert.props.title = _('USB key problem')
-                alert.props.msg = \
-                    _('We need to run a file check.')
-                alert.connect('response', self._dos_fsck_alert_cb)
-                self.add_alert(alert)
-                self._load_intro_graphics(file_name='fsck-usb.html')
-                return False
+                return self._usb_sync_failed(usb_data_path, e)
 
             # ...save a shadow copy in Sugar
-            fd = open(sugar_data_path, 'w')
-            fd.write(json_data)
-            fd.close()
+            self.io.call(trainingdata.save, sugar_data_path, data_one)
+            self._invalidate_task_data_cache()
             return True
         else:
             _logger.error('No data to sync on USB')
             return False
 
+    def _usb_sync_failed(self, usb_data_path, e):
+        self._fatal_error = True
+        _logger.error('Fatal error: could not write to %s: %s' %
+                      (usb_data_path, e))
+
+        # Don't try remounting since we are going to close.
+        self.volume_monitor.disconnect(self._mount_added_id)
+        self.volume_monitor.disconnect(self._mount_removed_id)
+
+        alert = ConfirmationAlert()
+        alert.props.title = _('USB key problem')
+        alert.props.msg = \
+            _('We need to run a file check.')
+        alert.connect('response', self._dos_fsck_alert_cb)
+        self.add_alert(alert)
+        self._load_intro_graphics(file_name='fsck-usb.html')
+        return False
+
+    def _exchange_changes(self, usb_data_path, usb_data, sugar_data_path,
+                          sugar_data):
+        ''' Copy each key that differs between the USB and Sugar copies from
+            the copy that modified it most recently to the other one. '''
+        usb_stamps = usb_data[trainingdata.MODIFIED]
+        sugar_stamps = sugar_data[trainingdata.MODIFIED]
+        # On a tie, we go with the copy that was committed last.
+        usb_is_newer = trainingdata.get_generation(usb_data) >= \
+            trainingdata.get_generation(sugar_data)
+
+        to_usb = {}
+        to_sugar = {}
+        for uid in set(usb_data.keys()) | set(sugar_data.keys()):
+            if uid in [trainingdata.GENERATION, trainingdata.MODIFIED]:
+                continue
+            if uid not in sugar_data:
+                to_sugar[uid] = usb_data[uid]
+            elif uid not in usb_data:
+                to_usb[uid] = sugar_data[uid]
+            elif usb_data[uid] == sugar_data[uid]:
+                continue
+            elif usb_stamps.get(uid, -1) > sugar_stamps.get(uid, -1) or \
+                 (usb_stamps.get(uid, -1) == sugar_stamps.get(uid, -1) and
+                  usb_is_newer):
+                to_sugar[uid] = usb_data[uid]
+            else:
+                to_usb[uid] = sugar_data[uid]
+
+        if len(to_usb) == 0 and len(to_sugar) == 0:
+            _logger.debug('data sync: USB and Sugar data match')
+            return True
+
+        _logger.debug('data sync: %d keys to USB, %d keys to Sugar' %
+                      (len(to_usb), len(to_sugar)))
+        generation = max(trainingdata.get_generation(usb_data),
+                         trainingdata.get_generation(sugar_data)) + 1
+        to_usb[trainingdata.GENERATION] = generation
+        to_sugar[trainingdata.GENERATION] = generation
+
+        try:
+            self.io.call(trainingdata.append, usb_data_path, to_usb,
+                         sugar_stamps)
+        except Exception, e:
+            return self._usb_sync_failed(usb_data_path, e)
+
+        self.io.call(trainingdata.append, sugar_data_path, to_sugar,
+                     usb_stamps)
+        self._invalidate_task_data_cache()
+        return True
+
+    def _merge_data(self, usb_data, sugar_data):
+        ''' Merge the USB and Sugar copies of the training data, key by key '''
+
+        def count_completed(data):
+            count = 0
+            for key in data:
+                if isinstance(data[key], dict) and \
+                   'completed' in data[key] and \
+                   data[key]['completed']:
+                    count += 1
+            return count
+
+        # The database with the most completed tasks takes precedence.
+        if count_completed(usb_data) >= count_completed(sugar_data):
+            _logger.debug('data sync: USB data takes precedence')
+            data_one = usb_data
+            data_two = sugar_data
+        else:
+            _logger.debug('data sync: Sugar data takes precedence')
+            data_one = sugar_data
+            data_two = usb_data
+
+        # Copy completed tasks from one to two
+        for key in data_one:
+            if isinstance(data_one[key], dict) and \
+               'completed' in data_one[key] and \
+               data_one[key]['completed']:
+                data_two[key] = data_one[key]
+
+        # Copy completed tasks from two to one
+        for key in data_two:
+            if isinstance(data_two[key], dict) and \
+               'completed' in data_two[key] and \
+               data_two[key]['completed']:
+                data_one[key] = data_two[key]
+
+        # Copy incompleted tasks from one to two
+        for key in data_one:
+            if isinstance(data_one[key], dict) and \
+               (not 'completed' in data_one[key] or
+                not data_one[key]['completed']):
+                    data_two[key] = data_one[key]
+
+        # Copy incompleted tasks from two to one
+        for key in data_two:
+            if isinstance(data_two[key], dict) and \
+               (not 'completed' in data_two[key] or
+                not data_two[key]['completed']):
+                    data_one[key] = data_two[key]
+
+        # Copy name, email_address, current_task...
+        for key in data_one:
+            if not isinstance(data_one[key], dict):
+                data_two[key] = data_one[key]
+        for key in data_two:
+            if not isinstance(data_two[key], dict):
+                data_one[key] = data_two[key]
+
+        return data_one
+
     def _copy_data_from_USB(self):
         usb_path = self._check_for_USB_data()
         if usb_path is not None:
             try:
-                subprocess.call(['cp', usb_path,
-                                 self.volume_data[0]['sugar_path']])
-            except OSError as e:
+                self.io.call(trainingdata.copy, usb_path, os.path.join(
+                    self.volume_data[0]['sugar_path'],
+                    self.volume_data[0]['uid']))
+            except (IOError, OSError) as e:
                 _logger.error('Could not copy %s to %s: %s' % (
                     usb_path, self.volume_data[0]['sugar_path'], e))
+            self._invalidate_task_data_cache()
         else:
             _logger.error('No data found on USB')
 
+    def _invalidate_task_data_cache(self):
+        # We may have failed before getting to init of taskmaster
+        if hasattr(self, '_task_master'):
+            self._task_master.invalidate_task_data_cache()
+
     def toolbar_expanded(self):
         if self.activity_button.is_expanded():
             return True
@@ -841,6 +982,9 @@ class TrainingActivity(activity.Activity):
                 if name is None:
                     name = ''
                 self.metadata[TRAINING_DATA_FULLNAME] = name
+                # Sugar calls us from close(), after can_close(), and the
+                # I/O thread dies with the process.
+                self._task_master.flush_task_data(wait=True)
 
         self.metadata['font_size'] = str(self.font_size)
 
@@ -1042,6 +1186,11 @@ class TrainingActivity(activity.Activity):
         self._notify_transfer_status = state
 
     def _update_transfer_button(self, icon_name, tooltip):
+        self._transfer_status = (icon_name, tooltip)
+        if self._transfer_queue_depth > 0:
+            tooltip = '%s\n%s' % (tooltip,
+                                   _('Reports waiting to be sent: %d') %
+                                   self._transfer_queue_depth)
         self.transfer_button.set_icon_name(icon_name)
         self.transfer_button.set_tooltip(tooltip)
         if self._notify_transfer_status:
@@ -1069,6 +1218,10 @@ class TrainingActivity(activity.Activity):
         self._update_transfer_button('transfer-failed',
                                      _('Data transfer failed'))
 
+    def __transfer_queued_cb(self, widget, depth):
+        self._transfer_queue_depth = depth
+        self._update_transfer_button(*self._transfer_status)
+
     def __realize_cb(self, window):
         self.window_xid = window.get_window().get_xid()
 
@@ -1260,12 +1413,20 @@ class TrainingActivity(activity.Activity):
 
     def _mount_added_cb(self, volume_monitor, device):
         _logger.error('mount added')
+        self._volumes.invalidate()
+        self._invalidate_task_data_cache()
         if self.check_volume_data():
             _logger.debug('launching')
             self._launcher()
 
     def _mount_removed_cb(self, volume_monitor, device):
         _logger.error('mount removed')
+        # Save what we can (at least to Sugar) before the volume data change
+        if hasattr(self, '_task_master'):
+            self._task_master.flush_task_data(wait=True)
+        self._volumes.invalidate()
+        self.usb_watcher.stop()
+        self._invalidate_task_data_cache()
         if self.check_volume_data():
             _logger.debug('launching')
             self._launcher()
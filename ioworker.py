@@ -0,0 +1,93 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013,14 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+''' A thread for file I/O, so that a slow USB key does not freeze the UI
+
+Requests are run one at a time, in the order they were made, so a read
+made with call() sees every write submitted before it. Results of
+submit() are passed back to the main loop with idle_add. The functions
+run on the I/O thread must not touch any GTK or activity state.
+'''
+
+import threading
+import Queue
+
+from gi.repository import GObject
+
+import logging
+_logger = logging.getLogger('training-activity-ioworker')
+
+GObject.threads_init()
+
+
+class IOWorker(object):
+
+    def __init__(self):
+        self._queue = Queue.Queue()
+        self._thread = None
+
+    def _start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            func, args, callback = self._queue.get()
+            result = None
+            error = None
+            try:
+                result = func(*args)
+            except Exception, e:
+                _logger.error('I/O request %s failed: %s' %
+                              (func.__name__, e))
+                error = e
+            if callback is not None:
+                GObject.idle_add(self._callback, callback, result, error)
+
+    def _callback(self, callback, result, error):
+        callback(result, error)
+        return False
+
+    def submit(self, func, args=(), callback=None):
+        ''' Run func(*args) on the I/O thread; callback(result, error) is
+            then called from the main loop. '''
+        self._start()
+        self._queue.put((func, args, callback))
+
+    def call(self, func, *args):
+        ''' Run func(*args) on the I/O thread (after any requests already
+            queued) and wait for the result. Exceptions are re-raised. '''
+        if threading.current_thread() is self._thread:
+            return func(*args)
+        done = threading.Event()
+        outcome = {}
+
+        def run():
+            try:
+                outcome['result'] = func(*args)
+            except Exception, e:
+                outcome['error'] = e
+            finally:
+                done.set()
+
+        self.submit(run)
+        done.wait()
+        if 'error' in outcome:
+            raise outcome['error']
+        return outcome['result']
+
+    def wait(self):
+        ''' Wait for all of the queued requests to finish. '''
+        if self._thread is not None:
+            self.call(lambda: None)
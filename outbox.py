@@ -0,0 +1,144 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013,14 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+''' Reports waiting to be sent
+
+The outbox holds the latest report for each trainee (by training-data
+uid): a newer report supersedes an older one that has not been sent yet.
+It is saved to a file (committed the same way as the training data) so
+reports survive a failed transfer or a restart of the activity.
+
+Each report has a serial number, so when a transfer finishes we only
+remove the reports that have not been superseded in the meantime.
+
+The outbox also remembers, for each trainee, the tasks the server has
+acknowledged and how many delta reports have been acknowledged since the
+last full report, so that the Reporter can send only what changed.
+'''
+
+import os
+import json
+
+import trainingdata
+
+import logging
+_logger = logging.getLogger('training-activity-outbox')
+
+OUTBOX_FILE = '.report-outbox'
+# Version 2 reports list their tasks as (task uid, task) pairs.
+_VERSION = 2
+
+
+class Outbox(object):
+
+    def __init__(self, path):
+        self._path = path
+        self._reports = {}
+        self._serial = 0
+        self._serials = {}
+        # The acknowledged tasks by task uid, and the number of deltas
+        # since the last full report, by trainee
+        self._acknowledged = {}
+        self._load()
+
+    def _load(self):
+        if not os.path.exists(self._path):
+            return
+        try:
+            outbox = json.loads(trainingdata.read(self._path))
+        except (IOError, ValueError), e:
+            _logger.error('Could not read outbox %s: %s' % (self._path, e))
+            return
+        if not isinstance(outbox, dict):
+            _logger.error('Ignoring bad outbox %s' % self._path)
+            return
+        if 'reports' in outbox:
+            reports = outbox['reports']
+        else:
+            # Written before we kept track of acknowledgements
+            reports = outbox
+        if outbox.get('version') == _VERSION:
+            self._acknowledged = outbox.get('acknowledged', {})
+        else:
+            # The tasks are not known by uid: forget the acknowledgements,
+            # so that the next reports are full ones.
+            for uid in reports:
+                trainee, tasks = reports[uid]
+                reports[uid] = [trainee, [(None, task) for task in tasks]]
+        for uid in reports:
+            self._set(uid, reports[uid])
+
+    def _save(self):
+        try:
+            trainingdata.commit(self._path, json.dumps(
+                {'version': _VERSION,
+                 'reports': self._reports,
+                 'acknowledged': self._acknowledged}))
+        except (IOError, OSError), e:
+            # We still have the reports in memory.
+            _logger.error('Could not save outbox %s: %s' % (self._path, e))
+
+    def _set(self, uid, report):
+        self._serial += 1
+        self._reports[uid] = report
+        self._serials[uid] = self._serial
+
+    def __len__(self):
+        return len(self._reports)
+
+    def put(self, uid, report):
+        ''' Queue report (a JSON-serializable value) for the trainee with
+            uid, replacing any report of theirs still waiting. '''
+        self._set(uid, report)
+        self._save()
+
+    def get_reports(self):
+        ''' Returns a list of the waiting (uid, report) and a token to pass
+            to remove once they have been sent. '''
+        uids = sorted(self._reports)
+        return ([(uid, self._reports[uid]) for uid in uids],
+                dict([(uid, self._serials[uid]) for uid in uids]))
+
+    def get_acknowledged(self, uid):
+        ''' Returns a dictionary of the tasks of the trainee with uid that
+            the server has acknowledged, by task uid, and the number of
+            delta reports acknowledged since the last full report. '''
+        if uid not in self._acknowledged:
+            return {}, 0
+        return (self._acknowledged[uid]['tasks'],
+                self._acknowledged[uid]['deltas'])
+
+    def remove(self, token, acknowledged=None):
+        ''' Remove the reports returned (along with token) by get_reports,
+            except those superseded since. acknowledged is a dictionary of
+            the tasks sent (a list of (task uid, task)) and whether they
+            were a full report, by trainee. '''
+        if acknowledged is None:
+            acknowledged = {}
+        changed = False
+        for uid in token:
+            if self._serials.get(uid) == token[uid]:
+                del self._reports[uid]
+                del self._serials[uid]
+                changed = True
+        for uid in acknowledged:
+            tasks, full = acknowledged[uid]
+            if full or uid not in self._acknowledged:
+                self._acknowledged[uid] = {'tasks': {}, 'deltas': 0}
+            else:
+                self._acknowledged[uid]['deltas'] += 1
+            for task_uid, task in tasks:
+                if task_uid is not None:
+                    self._acknowledged[uid]['tasks'][task_uid] = task
+            changed = True
+        if changed:
+            self._save()
@@ -9,6 +9,7 @@
 # along with this library; if not, write to the Free Software
 # Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
 
+import os
 import json
 import logging
 
@@ -20,10 +21,46 @@ from gi.repository import Soup
 from activity import (TRAINING_DATA_UID, EMAIL_UID, NAME_UID,
                       SCHOOL_UID, COMPLETION_PERCENTAGE,
                       VERSION_NUMBER, ROLE_UID)
+from outbox import Outbox, OUTBOX_FILE
+import utils
 
 
 _logger = logging.getLogger('training-activity-reporter')
 
+# Defaults (in seconds) for the timeouts, if they are not set in GConf
+_CONNECT_TIMEOUT = 15
+_TOTAL_TIMEOUT = 60
+# How long (in seconds) to wait before sending the outbox again after a
+# failure; the delay doubles with each failure, up to _MAX_RETRY_DELAY.
+_RETRY_DELAY = 30
+_MAX_RETRY_DELAY = 60 * 60
+
+# Reports carry only the tasks that changed since the last report the
+# server acknowledged, with a full report after this many such deltas.
+_PAYLOAD_VERSION = 2
+_FULL_REPORT = 'full'
+_DELTA_REPORT = 'delta'
+_DELTAS_PER_FULL_REPORT = 10
+
+# One session for all reports, so that connections are kept alive
+_session = None
+
+
+def _get_session():
+    global _session
+    if _session is None:
+        _session = Soup.Session()
+        _session.add_feature_by_type(Soup.ProxyResolverDefault)
+    return _session
+
+
+def _is_online():
+    status = utils.nm_status()
+    # We cannot tell (e.g., on a wired network): try anyway.
+    if status is None or status == 'unknown':
+        return True
+    return not status.endswith('-disconnected')
+
 
 def _extract_trainee(data):
     trainee = []
@@ -47,11 +84,12 @@ def _extract_task(rawtask):
 
 
 def _extract_tasks(data):
+    ''' Returns a list of (task uid, task) for the completed tasks '''
     tasks = []
     for uid in data:
         if 'task' in uid and isinstance(data[uid], dict) and \
                 'completed' in data[uid] and data[uid]['completed']:
-            tasks.append(_extract_task(data[uid]))
+            tasks.append((uid, _extract_task(data[uid])))
     return tasks
 
 
@@ -59,6 +97,8 @@ class Reporter(GObject.GObject):
 
     URL = '/desktop/sugar/services/training/url'
     API_KEY = '/desktop/sugar/services/training/api_key'
+    CONNECT_TIMEOUT = '/desktop/sugar/services/training/connect_timeout'
+    TOTAL_TIMEOUT = '/desktop/sugar/services/training/total_timeout'
     TYPE = 'application/json'
 
     def __init__(self, activity):
@@ -66,7 +106,26 @@ class Reporter(GObject.GObject):
         client = GConf.Client.get_default()
         self._url = client.get_string(self.URL)
         self._api_key = client.get_string(self.API_KEY)
+        # get_int returns 0 if the key is not set
+        self._connect_timeout = client.get_int(self.CONNECT_TIMEOUT) or \
+            _CONNECT_TIMEOUT
+        self._total_timeout = client.get_int(self.TOTAL_TIMEOUT) or \
+            _TOTAL_TIMEOUT
         self._activity = activity
+        # The connect and total timeout ids of the messages being sent
+        self._timeouts = {}
+        self._outbox = Outbox(os.path.join(activity.get_activity_root(),
+                                           'data', OUTBOX_FILE))
+        # The outbox token of the reports being sent, and the tasks sent
+        # (see Outbox.remove)
+        self._sending = None
+        self._sent_tasks = {}
+        self._retry_delay = _RETRY_DELAY
+        self._retry_id = None
+
+    def get_queue_depth(self):
+        ''' The number of reports waiting to be sent '''
+        return len(self._outbox)
 
     def report(self, tasks_data_list):
         if not self._url or not self._api_key:
@@ -74,12 +133,57 @@ class Reporter(GObject.GObject):
             self._activity.transfer_failed_signal.emit()
             return
 
-        transport_data = []
         for tasks_data in tasks_data_list:
-            transport_data.append([_extract_trainee(tasks_data),
-                                   _extract_tasks(tasks_data)])
+            self._outbox.put(str(tasks_data.get(TRAINING_DATA_UID, None)),
+                             [_extract_trainee(tasks_data),
+                              _extract_tasks(tasks_data)])
+        self._activity.transfer_queued_signal.emit(len(self._outbox))
+        self.drain()
+
+    def drain(self):
+        ''' Send the reports in the outbox (all in one transfer), unless a
+            transfer is under way. '''
+        if self._retry_id is not None:
+            GObject.source_remove(self._retry_id)
+            self._retry_id = None
+        if self._sending is not None or len(self._outbox) == 0:
+            return
+        if not self._url or not self._api_key:
+            return
+        if not _is_online():
+            _logger.debug('reporter is waiting for the network')
+            self._retry()
+            return
 
-        self._send(json.dumps(transport_data))
+        reports, self._sending = self._outbox.get_reports()
+        transport_data = []
+        self._sent_tasks = {}
+        for uid, (trainee, tasks) in reports:
+            acknowledged, deltas = self._outbox.get_acknowledged(uid)
+            if len(acknowledged) == 0 or deltas >= _DELTAS_PER_FULL_REPORT:
+                report_type = _FULL_REPORT
+            else:
+                report_type = _DELTA_REPORT
+                tasks = [(task_uid, task) for task_uid, task in tasks
+                         if acknowledged.get(task_uid) != task]
+            transport_data.append({'type': report_type,
+                                   'trainee': trainee,
+                                   'tasks': [task for task_uid, task
+                                             in tasks]})
+            self._sent_tasks[uid] = (tasks, report_type == _FULL_REPORT)
+        self._send(json.dumps({'version': _PAYLOAD_VERSION,
+                               'reports': transport_data}))
+
+    def _retry(self):
+        _logger.debug('reporter will retry in %d seconds' % self._retry_delay)
+        self._retry_id = GObject.timeout_add_seconds(self._retry_delay,
+                                                     self.__retry_cb)
+        self._retry_delay = min(self._retry_delay * 2, _MAX_RETRY_DELAY)
+
+    def __retry_cb(self):
+        self._retry_id = None
+        self.drain()
+        return False
 
     def _send(self, data):
         uri = Soup.URI.new(self._url)
@@ -88,28 +192,62 @@ class Reporter(GObject.GObject):
         message.request_headers.append('x-api-key', self._api_key)
         message.set_request(self.TYPE, Soup.MemoryUse.COPY, data, len(data))
         message.connect('network-event', self.__network_event_cb)
+        message.connect('wrote-headers', self.__wrote_headers_cb)
         message.connect('wrote-body-data', self.__wrote_body_data_cb)
-        message.connect('finished', self.__finished_cb)
 
-        session = Soup.SessionSync()
-        session.add_feature_by_type(Soup.ProxyResolverDefault)
-        session.send_message(message)
+        self._timeouts[message] = [
+            GObject.timeout_add_seconds(self._connect_timeout,
+                                        self.__timeout_cb, message, 0,
+                                        Soup.Status.CANT_CONNECT),
+            GObject.timeout_add_seconds(self._total_timeout,
+                                        self.__timeout_cb, message, 1,
+                                        Soup.Status.IO_ERROR)]
+        _get_session().queue_message(message, self.__finished_cb, None)
+
+    def _remove_timeout(self, message, i):
+        if message in self._timeouts and self._timeouts[message][i]:
+            GObject.source_remove(self._timeouts[message][i])
+            self._timeouts[message][i] = None
+
+    def __timeout_cb(self, message, i, status):
+        _logger.error('reporter timed out (%d)' % status)
+        self._timeouts[message][i] = None
+        # __finished_cb removes the other timeout.
+        _get_session().cancel_message(message, status)
+        return False
 
     def __network_event_cb(self, message, event, connection):
         if event == Gio.SocketClientEvent.CONNECTED:
             _logger.debug('reporter connected to server')
-            self._activity.transfer_started_signal.emit()
+
+    def __wrote_headers_cb(self, message):
+        # The connection may be one kept alive from an earlier report.
+        self._remove_timeout(message, 0)
+        self._activity.transfer_started_signal.emit()
 
     def __wrote_body_data_cb(self, message, chunk):
         _logger.debug('reporter is trasmitting')
         self._activity.transfer_progressed_signal.emit()
 
-    def __finished_cb(self, message):
+    def __finished_cb(self, session, message, user_data):
+        self._remove_timeout(message, 0)
+        self._remove_timeout(message, 1)
+        if message in self._timeouts:
+            del self._timeouts[message]
+        token = self._sending
+        self._sending = None
         code = message.status_code
         if code == 200:
             _logger.debug('reporter completed transmission')
+            self._outbox.remove(token, self._sent_tasks)
+            self._retry_delay = _RETRY_DELAY
+            self._activity.transfer_queued_signal.emit(len(self._outbox))
             self._activity.transfer_completed_signal.emit()
+            # Send anything queued while we were sending.
+            self.drain()
         else:
             # error codes can be found at http://goo.gl/tWVJv2
             _logger.error('reporter failed transmitting, with code %d', code)
+            self._activity.transfer_queued_signal.emit(len(self._outbox))
             self._activity.transfer_failed_signal.emit()
+            self._retry()
@@ -0,0 +1,433 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013,14 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+''' The list of schools, indexed by postal code
+
+schools.txt holds one school per line:
+
+    sf_id,name,campus,address,city,state,postal_code
+
+Rather than reading and splitting the whole list whenever the postal code
+changes, we use an index built from it (at bundle build time by setup.py,
+or else on first use). The index file is:
+
+    header: magic, version, size, CRC-32 and modification time of
+            schools.txt, number of postal codes, length of the default
+            sf_id
+    the default sf_id (that of the Sugar Labs School)
+    a table of (postal code, offset, length) entries
+    the records: one "sf_id,display name" line per school, grouped by
+                 postal code
+
+The file is memory-mapped; only the table is read, into a dictionary, so
+a lookup is a dictionary access and a slice of the records. Whether the
+index is up to date is checked by stat-ing schools.txt. Unpacking the
+bundle does not keep the modification time, so if that differs we check
+the CRC-32 and, if the index is still good, rewrite it with the new
+modification time; schools.txt is only parsed when the index has to be
+rebuilt.
+
+For finding a school anywhere in the country (e.g., when the postal code
+was mistyped), SchoolSearch keeps an inverted index of the trigrams of
+the words in each school's name, campus, city, state and postal code.
+Matches are ranked by the (inverse document frequency) weight of the
+trigrams they share with the text, so small typos still match. The
+search index is cached on disk (in SEARCH_FILE) next to the postal code
+index.
+'''
+
+import os
+import re
+import math
+import heapq
+import marshal
+import mmap
+import struct
+import tempfile
+import zlib
+
+import logging
+_logger = logging.getLogger('training-activity-schoolindex')
+
+SCHOOLS_FILE = 'schools.txt'
+INDEX_FILE = 'schools.idx'
+SEARCH_FILE = 'schools.search'
+
+_MAGIC = 'TSIX'
+_VERSION = 3
+_HEADER = struct.Struct('<4sIIIdII')
+_ENTRY = struct.Struct('<HII')
+_DEFAULT_SCHOOL = 'Sugar Labs School'
+
+_SEARCH_VERSION = 3
+_WORD = re.compile(r'[a-z0-9]+')
+# Trigrams found in more than this share of the schools (e.g., those of
+# "school") only add to the scores of schools matched by other trigrams.
+_COMMON_TRIGRAM = 0.125
+
+_indexes = {}
+_searches = {}
+
+
+def _parse(contents):
+    ''' Returns the default sf_id and a list of (postal code, display name,
+        sf_id, search text) records, in the order of schools.txt. '''
+    default_sf_id = ''
+    schools = []
+    for school in contents.split('\n'):
+        if len(school) == 0:
+            continue
+        try:
+            sf_id, name, campus, address, city, state, postal_code = \
+                school.split(',')
+        except ValueError:
+            _logger.debug('bad school data? (%s)' % school)
+            continue
+        # save the SF_ID from Sugar Labs in case we need it
+        if name == _DEFAULT_SCHOOL:
+            default_sf_id = sf_id
+        try:
+            postal_code = int(postal_code)
+        except ValueError:
+            _logger.error('bad postal code? (%s: %s)' % (name, postal_code))
+            continue
+        if len(campus) > 0:
+            display_name = '%s %s, %s, %s' % (name, campus, city, state)
+        else:
+            display_name = '%s, %s, %s' % (name, city, state)
+        search_text = ' '.join([name, campus, city, state,
+                                '%04d' % postal_code])
+        schools.append((postal_code, display_name, sf_id, search_text))
+    return default_sf_id, schools
+
+
+def _get_stamp(path):
+    ''' The (size, modification time) of the file at path '''
+    stats = os.stat(path)
+    return stats.st_size, stats.st_mtime
+
+
+def _get_crc(contents):
+    return zlib.crc32(contents) & 0xffffffff
+
+
+def dumps(contents, stamp):
+    ''' The contents of the index for the contents of schools.txt, whose
+        stamp (see _get_stamp) is recorded in the header '''
+    default_sf_id, records = _parse(contents)
+    schools = {}
+    for postal_code, display_name, sf_id, search_text in records:
+        schools.setdefault(postal_code, []).append((display_name, sf_id))
+    table = []
+    records = []
+    offset = 0
+    for postal_code in sorted(schools):
+        record = '\n'.join(['%s,%s' % (sf_id, display_name)
+                            for display_name, sf_id in schools[postal_code]])
+        table.append(_ENTRY.pack(postal_code, offset, len(record)))
+        records.append(record)
+        offset += len(record)
+    header = _HEADER.pack(_MAGIC, _VERSION, stamp[0], _get_crc(contents),
+                          stamp[1], len(schools), len(default_sf_id))
+    return header + default_sf_id + ''.join(table) + ''.join(records)
+
+
+def _tokenize(text):
+    return _WORD.findall(text.lower())
+
+
+def _get_trigrams(word, partial=False):
+    ''' The trigrams of a word, padded with spaces so that short words
+        have trigrams too. A partial word (the one being typed) is not
+        padded at the end. '''
+    if partial:
+        padded = ' ' + word
+    else:
+        padded = ' ' + word + ' '
+    return [padded[i:i + 3] for i in range(len(padded) - 2)]
+
+
+def dumps_search(contents, stamp):
+    ''' The contents of the search index for the contents of schools.txt,
+        whose stamp (see _get_stamp) is recorded with it '''
+    records = []
+    postings = {}
+    for postal_code, display_name, sf_id, search_text in \
+            _parse(contents)[1]:
+        i = len(records)
+        records.append((display_name, sf_id, '%04d' % postal_code))
+        trigrams = set()
+        for word in _tokenize(search_text):
+            trigrams.update(_get_trigrams(word))
+        for trigram in trigrams:
+            postings.setdefault(trigram, []).append(i)
+    return marshal.dumps((_MAGIC, _SEARCH_VERSION, stamp[0],
+                          _get_crc(contents), stamp[1], records, postings))
+
+
+def _read(path):
+    fd = open(path, 'r')
+    try:
+        return fd.read()
+    finally:
+        fd.close()
+
+
+def build(bundle_path):
+    ''' Write the postal code and search indexes of the schools file in
+        bundle_path, unless they were already built from its contents.
+        Raises IOError or OSError on failure. '''
+    schools_path = os.path.join(bundle_path, SCHOOLS_FILE)
+    stamp = _get_stamp(schools_path)
+    contents = _read(schools_path)
+    for file_name, load, dumps_index in [(INDEX_FILE, _load, dumps),
+                                         (SEARCH_FILE, _load_search,
+                                          dumps_search)]:
+        path = os.path.join(bundle_path, file_name)
+        index = load(path)
+        if index is None or not index.matches_contents(contents):
+            _write(path, dumps_index(contents, stamp))
+
+
+def _write(index_path, index_data):
+    dir_path = os.path.dirname(index_path)
+    fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix='.schools-',
+                                    suffix='.tmp')
+    tmp_file = os.fdopen(fd, 'w')
+    try:
+        tmp_file.write(index_data)
+        tmp_file.close()
+        # mkstemp makes the file private; the bundle is shared.
+        os.chmod(tmp_path, 0644)
+        os.rename(tmp_path, index_path)
+    except:
+        tmp_file.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+class SchoolIndex(object):
+
+    def __init__(self, index_data):
+        ''' index_data is the contents of an index file: a string or an
+            mmap. Raises ValueError if it is not a valid index. '''
+        if len(index_data) < _HEADER.size:
+            raise ValueError('school index is truncated')
+        magic, version, self.source_size, self.source_crc, \
+            self.source_mtime, count, default_length = \
+            _HEADER.unpack(index_data[:_HEADER.size])
+        if magic != _MAGIC or version != _VERSION:
+            raise ValueError('not a school index (version %d)' % version)
+        offset = _HEADER.size
+        self.default_sf_id = index_data[offset:offset + default_length]
+        offset += default_length
+        records_offset = offset + count * _ENTRY.size
+        if len(index_data) < records_offset:
+            raise ValueError('school index is truncated')
+        self._table = {}
+        for i in range(count):
+            postal_code, start, length = _ENTRY.unpack(
+                index_data[offset:offset + _ENTRY.size])
+            self._table[postal_code] = (records_offset + start, length)
+            offset += _ENTRY.size
+        self._data = index_data
+
+    def matches(self, stamp):
+        ''' Was this index built from schools.txt as it is now (stamp, see
+            _get_stamp)? '''
+        return (self.source_size, self.source_mtime) == stamp
+
+    def matches_contents(self, contents):
+        ''' Was this index built from contents (of schools.txt)? '''
+        return self.source_size == len(contents) and \
+            self.source_crc == _get_crc(contents)
+
+    def dumps(self, stamp):
+        ''' The contents of this index, with a new stamp '''
+        return _HEADER.pack(_MAGIC, _VERSION, self.source_size,
+                            self.source_crc, stamp[1], len(self._table),
+                            len(self.default_sf_id)) + \
+            self._data[_HEADER.size:]
+
+    def get_schools(self, postal_code):
+        ''' Returns a list of (display name, sf_id) for the schools with
+            postal_code (an int). '''
+        if postal_code not in self._table:
+            return []
+        start, length = self._table[postal_code]
+        schools = []
+        for record in self._data[start:start + length].split('\n'):
+            sf_id, display_name = record.split(',', 1)
+            schools.append((display_name, sf_id))
+        return schools
+
+
+class SchoolSearch(object):
+
+    def __init__(self, search_data):
+        ''' search_data is the contents of a search index file. Raises
+            ValueError if it is not a valid search index. '''
+        try:
+            magic, version, self.source_size, self.source_crc, \
+                self.source_mtime, self._records, self._postings = \
+                marshal.loads(search_data)
+        except (ValueError, TypeError, EOFError), e:
+            raise ValueError('not a school search index: %s' % e)
+        if magic != _MAGIC or version != _SEARCH_VERSION:
+            raise ValueError('not a school search index (version %s)' %
+                             version)
+        count = float(max(len(self._records), 1))
+        self._weights = {}
+        for trigram in self._postings:
+            self._weights[trigram] = \
+                math.log(count / len(self._postings[trigram]))
+        self._common = count * _COMMON_TRIGRAM
+
+    def matches(self, stamp):
+        ''' Was this index built from schools.txt as it is now (stamp, see
+            _get_stamp)? '''
+        return (self.source_size, self.source_mtime) == stamp
+
+    def matches_contents(self, contents):
+        ''' Was this index built from contents (of schools.txt)? '''
+        return self.source_size == len(contents) and \
+            self.source_crc == _get_crc(contents)
+
+    def dumps(self, stamp):
+        ''' The contents of this index, with a new stamp '''
+        return marshal.dumps((_MAGIC, _SEARCH_VERSION, self.source_size,
+                              self.source_crc, stamp[1], self._records,
+                              self._postings))
+
+    def search(self, text, limit=6):
+        ''' Returns a list of up to limit (display name, sf_id, postal code)
+            for the schools that best match text, best first. The last word
+            of text is taken to be partially typed. '''
+        words = _tokenize(text)
+        trigrams = set()
+        for i, word in enumerate(words):
+            trigrams.update(_get_trigrams(word, partial=(
+                i == len(words) - 1 and not text[-1:].isspace())))
+        trigrams = [trigram for trigram in trigrams
+                    if trigram in self._postings]
+        # Rare trigrams first, so that common ones can be limited to the
+        # schools already found
+        trigrams.sort(key=lambda trigram: len(self._postings[trigram]))
+
+        scores = {}
+        for trigram in trigrams:
+            weight = self._weights[trigram]
+            if len(self._postings[trigram]) > self._common and \
+               len(scores) > 0:
+                for i in self._postings[trigram]:
+                    if i in scores:
+                        scores[i] += weight
+            else:
+                for i in self._postings[trigram]:
+                    scores[i] = scores.get(i, 0) + weight
+
+        best = heapq.nlargest(limit, scores.iteritems(),
+                              key=lambda score: (score[1], -score[0]))
+        return [self._records[i] for i, score in best]
+
+
+def _load(index_path):
+    ''' Memory-map the index file at index_path. Returns None if there is
+        no valid index there. '''
+    if not os.path.exists(index_path):
+        return None
+    try:
+        fd = open(index_path, 'r')
+        try:
+            index_data = mmap.mmap(fd.fileno(), 0, access=mmap.ACCESS_READ)
+        finally:
+            fd.close()
+        return SchoolIndex(index_data)
+    except (IOError, OSError, ValueError, mmap.error), e:
+        _logger.error('Could not load school index %s: %s' % (index_path, e))
+        return None
+
+
+def _load_search(search_path):
+    ''' Load the search index file at search_path. Returns None if there
+        is no valid search index there. '''
+    if not os.path.exists(search_path):
+        return None
+    try:
+        return SchoolSearch(_read(search_path))
+    except (IOError, ValueError), e:
+        _logger.error('Could not load school search index %s: %s' %
+                      (search_path, e))
+        return None
+
+
+def _get_cached(bundle_path, data_path, file_name, load, dumps, loads):
+    ''' Returns the index (loaded by load(path)) stored in file_name, using
+        the one built with the bundle if it is up to date (i.e., it has
+        the size and modification time of schools.txt). Otherwise the index
+        is rewritten with the new modification time if it was built from
+        the same contents, or else built (from dumps(contents, stamp)), in
+        bundle_path or, if that is read-only, in data_path; failing that,
+        it is kept in memory (and made by loads(data)). '''
+    schools_path = os.path.join(bundle_path, SCHOOLS_FILE)
+    stamp = _get_stamp(schools_path)
+
+    paths = []
+    indexes = []
+    for dir_path in [bundle_path, data_path]:
+        path = os.path.join(dir_path, file_name)
+        index = load(path)
+        if index is not None and index.matches(stamp):
+            return index
+        paths.append(path)
+        indexes.append(index)
+
+    contents = _read(schools_path)
+    for index in indexes:
+        if index is not None and index.matches_contents(contents):
+            index_data = index.dumps(stamp)
+            break
+    else:
+        _logger.debug('building school index %s' % file_name)
+        index_data = dumps(contents, stamp)
+
+    for path in paths:
+        try:
+            _write(path, index_data)
+        except (IOError, OSError), e:
+            _logger.error('Could not write school index %s: %s' % (path, e))
+            continue
+        index = load(path)
+        if index is not None:
+            return index
+    return loads(index_data)
+
+
+def get_index(bundle_path, data_path):
+    ''' Returns the SchoolIndex for the schools file in bundle_path (see
+        _get_cached). '''
+    if bundle_path not in _indexes:
+        _indexes[bundle_path] = _get_cached(bundle_path, data_path,
+                                            INDEX_FILE, _load, dumps,
+                                            SchoolIndex)
+    return _indexes[bundle_path]
+
+
+def get_search(bundle_path, data_path):
+    ''' Returns the SchoolSearch for the schools file in bundle_path (see
+        _get_cached). '''
+    if bundle_path not in _searches:
+        _searches[bundle_path] = _get_cached(bundle_path, data_path,
+                                             SEARCH_FILE, _load_search,
+                                             dumps_search, SchoolSearch)
+    return _searches[bundle_path]
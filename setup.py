@@ -1,5 +1,22 @@
 #!/usr/bin/env python
+import os
+import sys
+
 from sugar3.activity import bundlebuilder
 
+import schoolindex
+
+# Commands that package the bundle, and so should bring the school
+# indexes up to date. The indexes are checked in: the bundle is packaged
+# from the files known to git.
+_PACKAGE_COMMANDS = ['build', 'dist_xo', 'install']
+
 if __name__ == "__main__":
+    if len(sys.argv) > 1 and sys.argv[1] in _PACKAGE_COMMANDS:
+        # Ship the school indexes with the bundle (see schoolindex).
+        try:
+            schoolindex.build(os.path.dirname(os.path.abspath(__file__)))
+        except (IOError, OSError), e:
+            # They will be built on first use.
+            print 'Could not build the school indexes: %s' % e
     bundlebuilder.start()
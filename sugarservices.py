@@ -0,0 +1,153 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013,14 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+''' A client for the org.sugarlabs.SugarServices D-Bus service
+
+One proxy is shared by all callers and is recreated if a call fails or
+the service is restarted. Calls can be made asynchronously, and an
+asynchronous call that is already in flight is not made again. The
+results of state queries (e.g., GetActivityName) are cached: the first
+query waits for the result, and after that they are refreshed in the
+background whenever the service emits a signal or is restarted (and, in
+case we miss a signal, once in a long while).
+'''
+
+import time
+
+import dbus
+
+import logging
+_logger = logging.getLogger('training-activity-sugarservices')
+
+DBUS_SERVICE = 'org.sugarlabs.SugarServices'
+DBUS_PATH = '/org/sugarlabs/SugarServices'
+
+# How long (in seconds) a cached state is used before it is refreshed,
+# should no signal tell us it has changed
+_STATE_TTL = 30
+
+_client = None
+
+
+def get_client():
+    ''' Returns the shared SugarServices client '''
+    global _client
+    if _client is None:
+        _client = SugarServices()
+    return _client
+
+
+class SugarServices(object):
+
+    def __init__(self):
+        self._proxy = None
+        self._watching = False
+        # Handlers for the asynchronous calls in flight, by call
+        self._pending = {}
+        # (time, result) of state queries, by method name
+        self._state = {}
+
+    def _get_interface(self):
+        if self._proxy is None:
+            bus = dbus.SessionBus()
+            self._proxy = bus.get_object(DBUS_SERVICE, DBUS_PATH)
+            if not self._watching:
+                bus.watch_name_owner(DBUS_SERVICE, self._name_owner_cb)
+                bus.add_signal_receiver(self._signal_cb,
+                                        dbus_interface=DBUS_SERVICE,
+                                        path=DBUS_PATH)
+                self._watching = True
+        return dbus.Interface(self._proxy, DBUS_SERVICE)
+
+    def _reset(self):
+        ''' Drop the proxy so that we reconnect. '''
+        self._proxy = None
+
+    def call(self, method, *args):
+        ''' Call method and wait for the result, reconnecting once if the
+            call fails. Raises dbus.DBusException on failure. '''
+        try:
+            return getattr(self._get_interface(), method)(*args)
+        except dbus.DBusException, e:
+            _logger.debug('%s failed (%s), reconnecting' % (method, e))
+            self._reset()
+        return getattr(self._get_interface(), method)(*args)
+
+    def call_async(self, method, args=(), reply_handler=None,
+                   error_handler=None):
+        ''' Call method without waiting; reply_handler(result) or
+            error_handler(exception) is called later from the main loop. '''
+        key = (method,) + tuple(args)
+        if key in self._pending:
+            self._pending[key].append((reply_handler, error_handler))
+            return
+        self._pending[key] = [(reply_handler, error_handler)]
+        try:
+            getattr(self._get_interface(), method)(
+                *args,
+                reply_handler=lambda *result: self._reply_cb(key, result),
+                error_handler=lambda error: self._error_cb(key, error))
+        except dbus.DBusException, e:
+            self._error_cb(key, e)
+
+    def _reply_cb(self, key, result):
+        if len(result) == 0:
+            result = None
+        elif len(result) == 1:
+            result = result[0]
+        for reply_handler, error_handler in self._pending.pop(key, []):
+            if reply_handler is not None:
+                reply_handler(result)
+
+    def _error_cb(self, key, error):
+        _logger.error('ERROR calling %s: %s' % (key[0], error))
+        self._reset()
+        for reply_handler, error_handler in self._pending.pop(key, []):
+            if error_handler is not None:
+                error_handler(error)
+
+    def get_state(self, method, default=None):
+        ''' The (cached) result of calling method, which must not take any
+            arguments. The first call for method waits for the result;
+            returns default if it fails. '''
+        if method not in self._state:
+            try:
+                self._state[method] = (time.time(), self.call(method))
+            except dbus.DBusException, e:
+                _logger.error('ERROR calling %s: %s' % (method, e))
+                return default
+        elif time.time() - self._state[method][0] >= _STATE_TTL:
+            # Use the state we have (without asking again) until the
+            # reply arrives.
+            self._state[method] = (time.time(), self._state[method][1])
+            self.refresh(method)
+        return self._state[method][1]
+
+    def refresh(self, method):
+        def reply_handler(result):
+            self._state[method] = (time.time(), result)
+
+        self.call_async(method, reply_handler=reply_handler)
+
+    def _signal_cb(self, *args):
+        # The shell state has changed: refresh whatever we have cached.
+        for method in self._state.keys():
+            self.refresh(method)
+
+    def _name_owner_cb(self, owner):
+        # The service was (re)started or went away.
+        if self._proxy is not None:
+            self._reset()
+        if owner:
+            self._signal_cb()
+        else:
+            self._state = {}
@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013,14 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+''' Events that can change the outcome of a task's test
+
+A task lists the events it cares about in Task.get_events(); while the
+task is running, its test is run when one of them happens rather than
+once a second.
+'''
+
+from gi.repository import Gio
+
+from sugar3 import env
+from sugar3.datastore import datastore
+
+import logging
+_logger = logging.getLogger('training-activity-taskevents')
+
+# A Journal entry was created or updated (e.g., an activity was launched
+# or closed).
+DATASTORE = 'datastore'
+# The list of favorite activities changed.
+FAVORITES = 'favorites'
+# A file on the USB key changed (see usbwatch).
+USB = 'usb'
+# The activity window gained or lost the focus (e.g., the user zoomed
+# out to the Home view and back).
+FOCUS = 'focus'
+# A key was pressed (emitted by the TaskMaster).
+KEYPRESS = 'keypress'
+
+
+class TaskEvents(object):
+
+    def __init__(self, activity, callback):
+        ''' callback(event) is called when a subscribed event happens. '''
+        self._activity = activity
+        self._callback = callback
+        self._events = set()
+        self._monitors = {}
+        self._focus_ids = []
+
+    def subscribe(self, events):
+        ''' Watch for (only) the listed events. '''
+        events = set(events)
+        for event in self._events - events:
+            self._disconnect(event)
+        for event in events - self._events:
+            self._connect(event)
+        self._events = events
+
+    def unsubscribe(self):
+        self.subscribe([])
+
+    def emit(self, event):
+        if event in self._events:
+            self._callback(event)
+
+    def _connect(self, event):
+        if event == DATASTORE:
+            datastore.created.connect(self._datastore_cb)
+            datastore.updated.connect(self._datastore_cb)
+        elif event == FAVORITES:
+            self._monitor(event,
+                          env.get_profile_path('favorite_activities'),
+                          directory=False)
+        elif event == USB:
+            if len(self._activity.volume_data) > 0:
+                self._activity.usb_watcher.watch(
+                    self._activity.volume_data[0]['usb_path'])
+            self._activity.usb_watcher.add_listener(self._usb_cb)
+        elif event == FOCUS:
+            self._focus_ids = [
+                self._activity.connect('focus-in-event', self._focus_cb),
+                self._activity.connect('focus-out-event', self._focus_cb)]
+
+    def _disconnect(self, event):
+        if event == DATASTORE:
+            datastore.created.disconnect(self._datastore_cb)
+            datastore.updated.disconnect(self._datastore_cb)
+        elif event == USB:
+            self._activity.usb_watcher.remove_listener(self._usb_cb)
+        elif event in self._monitors:
+            self._monitors[event].cancel()
+            del self._monitors[event]
+        elif event == FOCUS:
+            for focus_id in self._focus_ids:
+                self._activity.disconnect(focus_id)
+            self._focus_ids = []
+
+    def _monitor(self, event, path, directory):
+        gfile = Gio.File.new_for_path(path)
+        try:
+            if directory:
+                monitor = gfile.monitor_directory(Gio.FileMonitorFlags.NONE,
+                                                  None)
+            else:
+                monitor = gfile.monitor_file(Gio.FileMonitorFlags.NONE, None)
+        except Exception, e:
+            # We will still be polled once in a while.
+            _logger.error('Cannot monitor %s: %s' % (path, e))
+            return
+        monitor.connect('changed', self._file_changed_cb, event)
+        self._monitors[event] = monitor
+
+    def _datastore_cb(self, sender, **kwargs):
+        self._callback(DATASTORE)
+
+    def _usb_cb(self, path):
+        self._callback(USB)
+
+    def _file_changed_cb(self, monitor, gfile, other_file, event_type, event):
+        self._callback(event)
+
+    def _focus_cb(self, widget, event):
+        self._callback(FOCUS)
+        return False
@@ -0,0 +1,108 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013,14 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+''' The requirements of the tasks (see Task.get_requires) as a graph
+
+Each task keeps a count of its requirements that have not been completed,
+updated as tasks are completed, so checking whether a task can be run
+does not require looking at its requirements.
+'''
+
+import logging
+_logger = logging.getLogger('training-activity-taskgraph')
+
+
+class TaskGraph(object):
+
+    def __init__(self, uids, requires):
+        ''' uids is the list of task uids (in task order); requires maps
+            each uid to the list of uids it requires. '''
+        self._requires = {}
+        self._dependents = {}
+        for uid in uids:
+            self._requires[uid] = []
+            self._dependents[uid] = []
+        for uid in uids:
+            for required in requires.get(uid, []):
+                if required not in self._requires:
+                    _logger.error('Task %s requires unknown task %s' %
+                                  (uid, required))
+                    continue
+                if required not in self._requires[uid]:
+                    self._requires[uid].append(required)
+                    self._dependents[required].append(uid)
+        self.order = self._sort(uids)
+        self.reset(set())
+
+    def _sort(self, uids):
+        ''' Topological order of the uids, otherwise keeping task order '''
+        pending = {}
+        for uid in uids:
+            pending[uid] = len(self._requires[uid])
+        order = []
+        ready = [uid for uid in uids if pending[uid] == 0]
+        while len(ready) > 0:
+            uid = ready.pop(0)
+            order.append(uid)
+            for dependent in self._dependents[uid]:
+                pending[dependent] -= 1
+                if pending[dependent] == 0:
+                    ready.append(dependent)
+        if len(order) < len(uids):
+            _logger.error('Task requirements have a cycle: %s' %
+                          [uid for uid in uids if pending[uid] > 0])
+            order.extend([uid for uid in uids if pending[uid] > 0])
+        return order
+
+    def reset(self, completed_uids):
+        ''' Recount the unmet requirements given the completed tasks. '''
+        self._completed = set(completed_uids)
+        self._unmet = {}
+        for uid in self._requires:
+            self._unmet[uid] = len([required for required in
+                                    self._requires[uid]
+                                    if required not in self._completed])
+
+    def set_completed(self, uid, completed):
+        if uid not in self._requires or completed == (uid in self._completed):
+            return
+        if completed:
+            self._completed.add(uid)
+            increment = -1
+        else:
+            self._completed.remove(uid)
+            increment = 1
+        for dependent in self._dependents[uid]:
+            self._unmet[dependent] += increment
+
+    def is_satisfied(self, uid):
+        ''' Have all of the tasks uid requires been completed? '''
+        return self._unmet.get(uid, 0) == 0
+
+    def first_unmet(self, uid):
+        ''' The first task uid requires that has not been completed, or
+            None '''
+        if self.is_satisfied(uid):
+            return None
+        for required in self._requires[uid]:
+            if required not in self._completed:
+                return required
+        return None
+
+    def first_runnable(self, uid):
+        ''' Follow the unmet requirements of uid back to a task whose own
+            requirements are satisfied. '''
+        seen = set()
+        while not self.is_satisfied(uid) and uid not in seen:
+            seen.add(uid)
+            uid = self.first_unmet(uid)
+        return uid
@@ -11,7 +11,7 @@
 # Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
 
 import os
-import json
+import copy
 import time
 from gettext import gettext as _
 
@@ -26,13 +26,81 @@ import logging
 _logger = logging.getLogger('training-activity-taskmaster')
 
 import tasks
+import taskevents
+from taskevents import TaskEvents
 from progressbar import ProgressBar
 import utils
+import trainingdata
+from taskgraph import TaskGraph
 from reporter import Reporter
 from graphics import Graphics
 from activity import (TRAINING_DATA_UID, NAME_UID, EMAIL_UID,
                       VERSION_NUMBER, COMPLETION_PERCENTAGE)
 
+# How long to collect changes to the training data before writing them out
+_FLUSH_DELAY = 500  # ms
+
+# How often to test a task that waits for events, in case we missed one
+_SAFETY_NET_DELAY = 15000  # ms
+# While the activity is in the background, the pause between tests of a
+# task is doubled after each failed test up to this limit.
+_MAX_PAUSE = 30000  # ms
+
+# USB files we failed to write to (only used on the I/O thread): records
+# queued after a failure must not be appended until the file is rewritten.
+_failed_usb_paths = set()
+
+
+def _get_data_stamp(path):
+    ''' The (mtime, size) of the file at path, or None '''
+    try:
+        stats = os.stat(path)
+    except OSError:
+        return None
+    return (stats.st_mtime, stats.st_size)
+
+
+def _write_task_data(usb_data_path, usb_contents, append, header,
+                     sugar_data_path, sugar_contents):
+    ''' Runs on the I/O thread: write the training data to the USB and
+        Sugar; returns the USB and Sugar errors (or None), and the path
+        and stamp (see _get_data_stamp) of the USB file once written. '''
+    usb_error = None
+    sugar_error = None
+    usb_stamp = None
+    if usb_contents is not None:
+        try:
+            if append:
+                if usb_data_path in _failed_usb_paths:
+                    raise IOError('an earlier write to %s failed' %
+                                  usb_data_path)
+                trainingdata.append_records(usb_data_path, usb_contents)
+            else:
+                trainingdata.commit(usb_data_path, usb_contents)
+                _failed_usb_paths.discard(usb_data_path)
+        except Exception, e:
+            usb_error = e
+            _failed_usb_paths.add(usb_data_path)
+        if usb_error is None:
+            usb_stamp = _get_data_stamp(usb_data_path)
+        if header is not None and usb_error is None:
+            _write_header(usb_data_path, header)
+    try:
+        trainingdata.commit(sugar_data_path, sugar_contents)
+    except Exception, e:
+        sugar_error = e
+    return usb_error, sugar_error, usb_data_path, usb_stamp
+
+
+def _write_header(usb_data_path, header):
+    ''' Runs on the I/O thread: write the (header, generation) pair. '''
+    try:
+        trainingdata.write_header(usb_data_path, header[0], header[1])
+    except Exception, e:
+        # The header is only a shortcut; readers fall back to the data.
+        _logger.error('Could not write header for %s: %s' %
+                      (usb_data_path, e))
+
 
 class TaskMaster(Gtk.Alignment):
 
@@ -40,6 +108,7 @@ class TaskMaster(Gtk.Alignment):
         ''' Initialize the task list '''
         Gtk.Alignment.__init__(self)
         self.activity = activity
+        self._io = activity.io
 
         self.set_size_request(Gdk.Screen.width() - style.GRID_CELL_SIZE, -1)
 
@@ -64,12 +133,51 @@ class TaskMaster(Gtk.Alignment):
         self._yes_task = None
         self._no_task = None
         self._task_list = tasks.get_tasks(self)
+        # Which tasks have data and which are completed, counted by
+        # section; see _rebuild_completion.
+        self._completion_valid = False
+        self._started_uids = set()
+        self._completed_uids = set()
+        self._section_started = []
+        self._section_completed = []
+        self._completed_collectables = 0
         self._task_data = None
         self._sugar_data_path = None
         self._resync_required = False
+        # In-memory copy of the training data on the USB key, along with
+        # the path of the file it was read from. All of our writes to the
+        # file go through the cache.
+        self._data = None
+        self._data_path = None
+        # Number of log records following the snapshot in the data file
+        self._data_records = 0
+        # The (mtime, size) of the data file as of our last read or write,
+        # so that changes made by someone else (e.g., the key was used on
+        # another machine) are noticed; not checked while our own writes
+        # are under way.
+        self._data_stamp = None
+        self._pending_writes = 0
+        # (path, header, generation) of the header file we last wrote
+        self._data_header = None
+        # Changes not yet written out to the USB key and Sugar
+        self._pending_data = {}
+        self._flush_id = None
         self._uid = None
         self._start_time = time.time()
         self._accumulated_time = 0
+        # The pending test of the current task
+        self._test_id = None
+        self._pause = None
+        # Number of tests and time spent testing, by task uid
+        self._test_stats = {}
+        self._task_events = TaskEvents(activity, self._task_event_cb)
+        activity.connect('focus-in-event', self._focus_in_cb)
+        # Some tasks look at the training data in get_requires, so index
+        # the tasks once the data cache is set up.
+        self._build_task_index()
+        # Send anything left in the outbox by an earlier session.
+        self._reporter = Reporter(activity)
+        self._reporter.drain()
 
         self._assign_required()
 
@@ -167,6 +275,7 @@ class TaskMaster(Gtk.Alignment):
 
     def keypress_cb(self, widget, event):
         self.keyname = Gdk.keyval_name(event.keyval)
+        self._task_events.emit(taskevents.KEYPRESS)
 
     def task_master(self):
         ''' 'nough said. '''
@@ -201,15 +310,17 @@ class TaskMaster(Gtk.Alignment):
                 if i > 10:
                     # Shouldn't happen but we want to avoid infinite loops
                     _logger.error('Breaking out of required task loop.')
+                    break
 
             self._first_time = True
             self._run_task(section_index, task_index)
         else:
+            self._cancel_test()
+            self._task_events.unsubscribe()
             self.update_completion_percentage(finished=True)
             _logger.error('Sending final report.')
             self._reported = True
-            reporter = Reporter(self.activity)
-            reporter.report([self.read_task_data()])
+            self.send_report()
 
             self._destroy_graphics()
             graphics = Graphics()
@@ -332,9 +443,12 @@ class TaskMaster(Gtk.Alignment):
             returns True or False, and perhaps some data '''
 
         task = self._task_list[section_index]['tasks'][task_index]
+        events = task.get_events()
+        first_time = self._first_time
         if self._first_time:
             _logger.error('Running task %d: %s' % (self.current_task,
                                                    task.uid))
+            self._task_events.subscribe(events or [])
 
             self._uid = task.uid
             '''
@@ -355,8 +469,53 @@ class TaskMaster(Gtk.Alignment):
 
             self._first_time = False
 
-        GObject.timeout_add(task.get_pause_time(), self._test, task.test,
-                            self._task_data, self._uid)
+        # Tasks that wait for events are tested once to begin with and then
+        # whenever an event arrives. Other tasks are polled, backing off
+        # while the user is busy in another activity.
+        if first_time or self.activity.is_active():
+            self._pause = task.get_pause_time()
+        else:
+            self._pause = min(self._pause * 2, _MAX_PAUSE)
+        if events is None or first_time:
+            self._schedule_test(task, self._pause)
+        else:
+            self._schedule_test(task, _SAFETY_NET_DELAY)
+
+    def _schedule_test(self, task, delay):
+        self._cancel_test()
+        self._test_id = GObject.timeout_add(delay, self._test_cb, task.test,
+                                            self._task_data, self._uid)
+
+    def _cancel_test(self):
+        if self._test_id is not None:
+            GObject.source_remove(self._test_id)
+            self._test_id = None
+
+    def _test_cb(self, test, task_data, uid):
+        self._test_id = None
+        self._test(test, task_data, uid)
+        return False
+
+    def _task_event_cb(self, event):
+        ''' Something the current task waits for happened, so test it now
+            (unless the test has already passed). '''
+        if self._test_id is None:
+            return
+        section_index, task_index = self.get_section_and_task_index()
+        task = self._task_list[section_index]['tasks'][task_index]
+        _logger.debug('%s: testing %s' % (event, task.uid))
+        self._pause = task.get_pause_time()
+        self._schedule_test(task, 0)
+
+    def _focus_in_cb(self, widget, event):
+        # The user is back: stop backing off.
+        self._task_event_cb(taskevents.FOCUS)
+        return False
+
+    def get_test_stats(self, uid):
+        ''' Returns the number of times the test of task uid was run and
+            the total time (in seconds) spent running it. '''
+        return tuple(self._test_stats.get(uid, (0, 0.)))
 
     def _init_task_data(self, task):
         # In order to calculate accumulated time, we need to monitor
@@ -389,7 +548,15 @@ class TaskMaster(Gtk.Alignment):
                 self._init_task_data(task)
                 task_data = self._task_data
 
-        if test(task_data):
+        start_time = time.time()
+        passed = test(task_data)
+        stats = self._test_stats.setdefault(uid, [0, 0.])
+        stats[0] += 1
+        stats[1] += time.time() - start_time
+
+        if passed:
+            _logger.debug('%s passed after %d tests (%.3f s)' %
+                          (uid, stats[0], stats[1]))
             if not 'completed' in task_data or not task_data['completed']:
                 task_data['end_time'] = int(time.time() + 0.5)
                 task_data['completed'] = True
@@ -411,6 +578,11 @@ class TaskMaster(Gtk.Alignment):
         if self._uid is not None:
             self.write_task_data(self._uid, self._task_data)
 
+    def send_report(self):
+        ''' Make sure the training data are written out before reporting. '''
+        self.flush_task_data(wait=True)
+        self._reporter.report([self.read_task_data()])
+
     def _jump_to_task_cb(self, widget, flag):
         ''' Jump to task associated with uid '''
         # First, make sure current task data is saved.
@@ -450,20 +622,29 @@ class TaskMaster(Gtk.Alignment):
                              switch_task=True):
         ''' Check to make sure all the requirements at met '''
         task = self._task_list[section_index]['tasks'][task_index]
-        requires = task.get_requires()
-        for uid in requires:
-            # Don't restrict search to current section
-            if not self.uid_to_task(uid, section=None).is_completed():
-                if switch_task:
-                    _logger.debug('Task %s requires task %s... switching' %
-                                  (task.uid, uid))
-                    self.current_task = self.uid_to_task_number(uid)
-                    section_index, task_index = \
-                        self.get_section_and_task_index()
-                    self.activity.progress_buttons[section_index].set_active(
-                        True)
-                return False
-        return True
+        self._check_completion()
+        if task.has_dynamic_requires():
+            # Not in the graph: check its current requirements.
+            uid = None
+            for required in task.get_requires():
+                if required not in self._completed_uids:
+                    uid = self._task_graph.first_runnable(required)
+                    break
+            if uid is None:
+                return True
+        elif self._task_graph.is_satisfied(task.uid):
+            return True
+        else:
+            uid = self._task_graph.first_runnable(task.uid)
+        if switch_task:
+            # Switch to a required task that can be run right away
+            task.requirements_not_met()
+            _logger.debug('Task %s requires task %s... switching' %
+                          (task.uid, uid))
+            self.current_task = self.uid_to_task_number(uid)
+            section_index, task_index = self.get_section_and_task_index()
+            self.activity.progress_buttons[section_index].set_active(True)
+        return False
 
     def reload_graphics(self):
         ''' When changing font size and zoom level, we regenerate the task
@@ -532,6 +713,94 @@ class TaskMaster(Gtk.Alignment):
 
         task.grab_focus()
 
+    def _build_task_index(self):
+        ''' The task list does not change, so index it once rather than
+            searching it each time we look up a task. '''
+        self._uid_to_task = {}
+        self._uid_to_task_number = {}
+        # (section index, task index) of each task, by task number
+        self._task_positions = []
+        # Task number of the first task in each section
+        self._section_offsets = []
+        self._section_collectables = []
+        for section_index, section in enumerate(self._task_list):
+            self._section_offsets.append(len(self._task_positions))
+            collectables = 0
+            for task_index, task in enumerate(section['tasks']):
+                if task.uid not in self._uid_to_task:
+                    self._uid_to_task[task.uid] = task
+                    self._uid_to_task_number[task.uid] = \
+                        len(self._task_positions)
+                self._task_positions.append((section_index, task_index))
+                if task.is_collectable():
+                    collectables += 1
+            self._section_collectables.append(collectables)
+        self._number_of_collectables = sum(self._section_collectables)
+        requires = {}
+        for uid, task in self._uid_to_task.iteritems():
+            # Dynamic requirements are checked as we go (see
+            # requirements_are_met).
+            if not task.has_dynamic_requires():
+                requires[uid] = task.get_requires()
+        self._task_graph = TaskGraph(
+            sorted(self._uid_to_task_number,
+                   key=self._uid_to_task_number.get), requires)
+        # Number of distinct uids in each section
+        self._section_sizes = [0] * len(self._task_list)
+        for uid in self._uid_to_task_number:
+            self._section_sizes[self._get_task_section(uid)] += 1
+
+    def _get_task_section(self, uid):
+        return self._task_positions[self._uid_to_task_number[uid]][0]
+
+    def _rebuild_completion(self):
+        ''' Count the started and completed tasks from scratch (after the
+            training data are loaded or resynced); from then on, the counts
+            are kept up to date by write_task_data. '''
+        data = self.read_task_data()
+        self._started_uids = set()
+        self._completed_uids = set()
+        self._section_started = [0] * len(self._task_list)
+        self._section_completed = [0] * len(self._task_list)
+        self._completed_collectables = 0
+        for uid in self._uid_to_task:
+            self._update_completion(uid, data.get(uid))
+        self._task_graph.reset(self._completed_uids)
+        self._completion_valid = True
+
+    def _update_completion(self, uid, task_data):
+        ''' Update the counts when the data for task uid change. '''
+        if uid not in self._uid_to_task:
+            return
+        section_index = self._get_task_section(uid)
+        if task_data is not None and uid not in self._started_uids:
+            self._started_uids.add(uid)
+            self._section_started[section_index] += 1
+
+        completed = isinstance(task_data, dict) and \
+            bool(task_data.get('completed', False))
+        if completed == (uid in self._completed_uids):
+            return
+        if completed:
+            self._completed_uids.add(uid)
+            increment = 1
+        else:
+            self._completed_uids.remove(uid)
+            increment = -1
+        self._task_graph.set_completed(uid, completed)
+        if self._uid_to_task[uid].is_collectable():
+            self._section_completed[section_index] += increment
+            self._completed_collectables += increment
+
+    def _check_completion(self):
+        if not self._completion_valid:
+            self._rebuild_completion()
+
+    def is_task_completed(self, uid):
+        ''' Like Task.is_completed, but from the completion counts '''
+        self._check_completion()
+        return uid in self._completed_uids
+
     def get_bundle_path(self):
         return self.activity.bundle_path
 
@@ -545,17 +814,18 @@ class TaskMaster(Gtk.Alignment):
         return self._task_list[section_index]['icon']
 
     def get_completed_sections(self):
+        self._check_completion()
         progress = []
-        for section_index, section in enumerate(self._task_list):
-            section_completed = True
+        for section_index in range(len(self._task_list)):
+            # Sections without collectables are completed once every task
+            # has been started.
             if self._get_number_of_collectables_in_section(section_index) == 0:
-                for task in section['tasks']:
-                    if self.read_task_data(task.uid) is None:
-                        section_completed = False
+                section_completed = self._section_started[section_index] == \
+                    self._section_sizes[section_index]
             else:
-                for task in section['tasks']:
-                    if task.is_collectable() and not task.is_completed():
-                        section_completed = False
+                section_completed = \
+                    self._section_completed[section_index] == \
+                    self._section_collectables[section_index]
             if section_completed:
                 progress.append(section_index)
         return progress
@@ -573,92 +843,104 @@ class TaskMaster(Gtk.Alignment):
             return section['tasks'][task_index].uid
 
     def uid_to_task_number(self, uid):
-        i = 0
-        for section in self._task_list:
-            for task in section['tasks']:
-                if task.uid == uid:
-                    return i
-                i += 1
+        if uid in self._uid_to_task_number:
+            return self._uid_to_task_number[uid]
         _logger.error('UID %s not found' % uid)
         return 0
 
     def get_section_and_task_index(self):
-        count = 0
-        for section_index, section in enumerate(self._task_list):
-            for task_index in range(len(section['tasks'])):
-                if count == self.current_task:
-                    return section_index, task_index
-                count += 1
+        if self.current_task is not None and \
+           0 <= self.current_task < len(self._task_positions):
+            return self._task_positions[self.current_task]
         return -1, -1
 
     def _get_number_of_tasks_in_section(self, section_index):
         return len(self._task_list[section_index]['tasks'])
 
     def _get_number_of_collectables_in_section(self, section_index):
-        count = 0
-        for task in self._task_list[section_index]['tasks']:
-            if task.is_collectable():
-                count += 1
-        return count
+        return self._section_collectables[section_index]
 
     def _get_number_of_collectables(self):
-        count = 0
-        for section_index in range(len(self._task_list)):
-            count += self._get_number_of_collectables_in_section(section_index)
-        return count
+        return self._number_of_collectables
 
     def _get_number_of_tasks(self):
-        count = 0
-        for section in self._task_list:
-            count += len(section['tasks'])
-        return count
+        return len(self._task_positions)
 
     def uid_to_task(self, uid, section=None):
-        if section:
-            for task in section['tasks']:
-                if task.uid == uid:
-                    return task
-        else:
-            for section in self._task_list:
-                for task in section['tasks']:
-                    if task.uid == uid:
-                        return task
+        task = self._uid_to_task.get(uid)
+        if task is not None and (not section or task in section['tasks']):
+            return task
         _logger.error('UID %s not found' % uid)
         return self._task_list[0]['tasks'][0]
 
     def _get_number_of_completed_tasks(self):
-        count = 0
-        for section in self._task_list:
-            for task in section['tasks']:
-                if task.is_completed():
-                    count += 1
-        return count
+        self._check_completion()
+        return len(self._completed_uids)
 
     def _get_number_of_completed_collectables(self):
-        count = 0
-        for section in self._task_list:
-            for task in section['tasks']:
-                if task.is_collectable() and task.is_completed():
-                    count += 1
-        return count
+        self._check_completion()
+        return self._completed_collectables
+
+    def _get_data_paths(self):
+        ''' Return the paths to the training data on the USB and in Sugar '''
+        if len(self.activity.volume_data) == 0:
+            return None, self._sugar_data_path
+        volume = self.activity.volume_data[0]
+        return (os.path.join(volume['usb_path'], volume['uid']),
+                os.path.join(volume['sugar_path'], volume['uid']))
+
+    def _data_cache_is_valid(self, usb_data_path):
+        if self._data is None or self._resync_required:
+            return False
+        if usb_data_path is None or usb_data_path != self._data_path:
+            return False
+        if self._pending_writes == 0 and \
+           _get_data_stamp(usb_data_path) != self._data_stamp:
+            _logger.debug('%s was changed behind our back' % usb_data_path)
+            return False
+        return True
+
+    def _set_data_cache(self, data, usb_data_path, records):
+        self._data = data
+        self._data_path = usb_data_path
+        self._data_records = records
+
+    def invalidate_task_data_cache(self):
+        ''' Forget the in-memory copy of the training data, e.g., when a
+            USB key is mounted or unmounted. '''
+        self._data = None
+        self._data_path = None
+        self._data_stamp = None
+        self._completion_valid = False
 
     def read_task_data(self, uid=None):
-        usb_data_path = None
-        sugar_data_path = self._sugar_data_path
-        uid_data = None
+        # Hand out copies so that callers cannot modify the cache behind
+        # our back.
+        if uid is not None and uid in self._pending_data:
+            return copy.deepcopy(self._pending_data[uid])
+
+        usb_data_path, sugar_data_path = self._get_data_paths()
+        if self._data_cache_is_valid(usb_data_path):
+            data = self._data
+        else:
+            data = self._load_task_data(usb_data_path, sugar_data_path)
+
+        if uid is None:
+            data = copy.deepcopy(data)
+            data.update(copy.deepcopy(self._pending_data))
+            return data
+        elif uid in data:
+            return copy.deepcopy(data[uid])
+        return None
+
+    def _load_task_data(self, usb_data_path, sugar_data_path):
         usb_read_failed = False
         data = {}
+        records = 0
 
-        if len(self.activity.volume_data) == 0:
+        if usb_data_path is None:
             _logger.error('No USB device found... trying to read from Sugar.')
             usb_read_failed = True
-        else:
-            usb_data_path = os.path.join(
-                self.activity.volume_data[0]['usb_path'],
-                self.activity.volume_data[0]['uid'])
-            sugar_data_path = os.path.join(
-                self.activity.volume_data[0]['sugar_path'],
-                self.activity.volume_data[0]['uid'])
 
         if usb_data_path is not None and os.path.exists(usb_data_path):
             if self._resync_required:
@@ -670,9 +952,8 @@ class TaskMaster(Gtk.Alignment):
                     _logger.error('RESYNC FAILED')
                 self._resync_required = not status
             try:
-                fd = open(usb_data_path, 'r')
-                json_data = fd.read()
-                fd.close()
+                json_data = self._io.call(trainingdata.read,
+                                          usb_data_path)
             except Exception, e:
                 # Maybe USB key has been pulled?
                 _logger.error('Could not read from %s: %s' %
@@ -681,7 +962,7 @@ class TaskMaster(Gtk.Alignment):
                 usb_read_failed = True
             try:
                 if len(json_data) > 0:
-                    data = json.loads(json_data)
+                    data, records = trainingdata.loads(json_data)
             except ValueError, e:
                 _logger.error('Cannot read training data: %s' % e)
                 usb_read_failed = True
@@ -693,50 +974,85 @@ class TaskMaster(Gtk.Alignment):
 
             if os.path.exists(sugar_data_path):
                 try:
-                    fd = open(sugar_data_path, 'r')
-                    json_data = fd.read()
-                    fd.close()
+                    json_data = self._io.call(trainingdata.read,
+                                              sugar_data_path)
                 except Exception, e:
                     json_data = ''
                     _logger.error('Could not read from %s: %s' %
                                   (sugar_data_path, e))
                 if len(json_data) > 0:
                     try:
-                        data = json.loads(json_data)
+                        data = trainingdata.loads(json_data)[0]
                     except ValueError, e:
                         _logger.error('Cannot load training data: %s' % e)
 
-        if uid is None:
-            return data
-        elif uid in data:
-            uid_data = data[uid]
+        # Only the USB copy is authoritative enough to cache.
+        if not usb_read_failed and usb_data_path is not None and \
+           os.path.exists(usb_data_path):
+            self._set_data_cache(data, usb_data_path, records)
+            # Our writes queued before the read are done by now.
+            self._data_stamp = _get_data_stamp(usb_data_path)
+        else:
+            self.invalidate_task_data_cache()
 
-        return uid_data
+        return data
 
     def write_task_data(self, uid, uid_data):
-        usb_data_path = None
-        sugar_data_path = self._sugar_data_path
+        ''' Mark uid as changed; the data are written out (along with any
+            other changes) the next time the main loop is idle. '''
+        self._pending_data[uid] = copy.deepcopy(uid_data)
+        if self._completion_valid:
+            self._update_completion(uid, uid_data)
+        if self._flush_id is None:
+            self._flush_id = GObject.timeout_add(_FLUSH_DELAY,
+                                                 self._flush_cb)
+
+    def _flush_cb(self):
+        self._flush_id = None
+        self.flush_task_data()
+        return False
+
+    def flush_task_data(self, wait=False):
+        ''' Write any pending changes to the USB and Sugar right away. If
+            wait, don't return until they (and any earlier writes) are on
+            disk, e.g., when the activity is about to be closed. '''
+        self._flush_pending_data()
+        if wait:
+            self._io.wait()
+
+    def _flush_pending_data(self):
+        if self._flush_id is not None:
+            GObject.source_remove(self._flush_id)
+            self._flush_id = None
+        if len(self._pending_data) == 0:
+            return
+
+        usb_data_path, sugar_data_path = self._get_data_paths()
         usb_read_failed = False
         sugar_read_failed = False
         data = {}
+        # We can only append to a data file whose contents we know.
+        records = None
 
-        if len(self.activity.volume_data) == 0:
+        if usb_data_path is None:
             _logger.error('No USB device found... cannot save results.')
             usb_read_failed = True
-        else:
-            sugar_data_path = os.path.join(
-                self.activity.volume_data[0]['sugar_path'],
-                self.activity.volume_data[0]['uid'])
-            usb_data_path = os.path.join(
-                self.activity.volume_data[0]['usb_path'],
-                self.activity.volume_data[0]['uid'])
-
-        # Read before write
-        if not usb_read_failed and os.path.exists(usb_data_path):
+
+        # Read before write (unless we already have the data in memory)
+        if self._data_cache_is_valid(usb_data_path):
+            data = self._data
+            records = self._data_records
+        elif not usb_read_failed and not os.path.exists(usb_data_path):
+            # The data file is created before we start, so the USB key
+            # has been pulled (e.g., we are flushing as it is unmounted).
+            # Don't replace the Sugar copy with only the pending changes.
+            _logger.error('%s is missing... cannot save results.' %
+                          usb_data_path)
+            usb_read_failed = True
+        elif not usb_read_failed:
             try:
-                fd = open(usb_data_path, 'r')
-                json_data = fd.read()
-                fd.close()
+                json_data = self._io.call(trainingdata.read,
+                                          usb_data_path)
             except Exception, e:
                 # Maybe USB key has been pulled?
                 _logger.error('Could not read from %s: %s' %
@@ -745,7 +1061,7 @@ class TaskMaster(Gtk.Alignment):
                 usb_read_failed = True
             if len(json_data) > 0:
                 try:
-                    data = json.loads(json_data)
+                    data, records = trainingdata.loads(json_data)
                 except ValueError, e:
                     _logger.error('Cannot load training data: %s' % e)
                     usb_read_failed = True
@@ -754,9 +1070,8 @@ class TaskMaster(Gtk.Alignment):
         if usb_read_failed and sugar_data_path is not None:
             if os.path.exists(sugar_data_path):
                 try:
-                    fd = open(sugar_data_path, 'r')
-                    json_data = fd.read()
-                    fd.close()
+                    json_data = self._io.call(trainingdata.read,
+                                              sugar_data_path)
                 except Exception, e:
                     _logger.error('Could not read from %s: %s' %
                                   (sugar_data_path, e))
@@ -764,47 +1079,96 @@ class TaskMaster(Gtk.Alignment):
                     sugar_read_failed = True
                 if len(json_data) > 0:
                     try:
-                        data = json.loads(json_data)
+                        data = trainingdata.loads(json_data)[0]
                     except ValueError, e:
                         _logger.error('Cannot load training data: %s' % e)
                         sugar_read_failed = True
 
         if usb_read_failed and sugar_read_failed:
+            # Hang on to the changes and try again with the next flush.
             _logger.error('Cannot read training data in read before write')
             return
 
-        data[uid] = uid_data
+        changes = self._pending_data
+        self._pending_data = {}
 
         # Make sure the volume UID and version number are present
-        data[TRAINING_DATA_UID] = self.activity.get_uid()
-        data[VERSION_NUMBER] = self.activity.get_activity_version()
-
-        json_data = json.dumps(data)
-
-        # Write to the USB and ...
+        if data.get(TRAINING_DATA_UID) != self.activity.get_uid():
+            changes[TRAINING_DATA_UID] = self.activity.get_uid()
+        if data.get(VERSION_NUMBER) != self.activity.get_activity_version():
+            changes[VERSION_NUMBER] = self.activity.get_activity_version()
+
+        trainingdata.apply_changes(data, changes)
+
+        # Write to the USB (appending to the log unless it is time to
+        # compact it) and save a shadow copy in Sugar, on the I/O thread.
+        # The cache is updated now; it is dropped if the write fails.
+        usb_contents = None
+        append = False
+        header = None
         if not usb_read_failed:
-            try:
-                fd = open(usb_data_path, 'w')
-                fd.write(json_data)
-                fd.close()
-            except Exception, e:
-                _logger.error('Could not write to USB %s: %s' %
-                              (usb_data_path, e))
-                _logger.error('write_task_data: Resync required')
-                self._resync_required = True
+            if records is not None and records + len(changes) <= \
+               trainingdata.COMPACT_THRESHOLD:
+                usb_contents = trainingdata.dumps_records(
+                    changes, data[trainingdata.MODIFIED])
+                append = True
+                records += len(changes)
+            else:
+                usb_contents = trainingdata.dumps_snapshot(data)
+                records = 0
+            self._set_data_cache(data, usb_data_path, records)
+            header = self._update_header(usb_data_path, data)
+        else:
+            self.invalidate_task_data_cache()
+            _logger.error('write_task_data: Resync required')
+            self._resync_required = True
 
-        # ... save shadow copy in Sugar
-        try:
-            fd = open(sugar_data_path, 'w')
-            fd.write(json_data)
-            fd.close()
+        self._pending_writes += 1
+        self._io.submit(_write_task_data,
+                        (usb_data_path, usb_contents, append, header,
+                         sugar_data_path, trainingdata.dumps_snapshot(data)),
+                        self._write_task_data_cb)
 
-            if usb_read_failed:
-                _logger.error('write_task_data: Resync required')
-                self._resync_required = True
-        except Exception, e:
-            _logger.error('Could not write to Sugar %s: %s' %
-                          (sugar_data_path, e))
+    def _write_task_data_cb(self, result, error):
+        self._pending_writes -= 1
+        if error is not None:
+            return
+        usb_error, sugar_error, usb_data_path, usb_stamp = result
+        if usb_stamp is not None and usb_data_path == self._data_path and \
+           self._pending_writes == 0:
+            self._data_stamp = usb_stamp
+        if usb_error is not None:
+            _logger.error('Could not write to USB: %s' % usb_error)
+            _logger.error('write_task_data: Resync required')
+            self._resync_required = True
+            self.invalidate_task_data_cache()
+        if sugar_error is not None:
+            _logger.error('Could not write to Sugar: %s' % sugar_error)
+
+    def _update_header(self, usb_data_path, data, force=False):
+        ''' Returns the (header, generation) to write alongside the USB data
+            if the header fields have changed or, if force, whenever it is
+            out of date; otherwise None. '''
+        header = utils.extract_training_data_header(data)
+        generation = trainingdata.get_generation(data)
+        if self._data_header is not None and \
+           self._data_header[0] == usb_data_path and \
+           self._data_header[1] == header and \
+           (not force or self._data_header[2] == generation):
+            return None
+        self._data_header = (usb_data_path, header, generation)
+        return header, generation
+
+    def save_task_data_header(self):
+        ''' Bring the header file up to date (e.g., before closing) so that
+            the next check of the USB key need not read the data file. '''
+        usb_data_path = self._get_data_paths()[0]
+        if usb_data_path is not None and \
+           self._data_cache_is_valid(usb_data_path):
+            header = self._update_header(usb_data_path, self._data,
+                                         force=True)
+            if header is not None:
+                self._io.submit(_write_header, (usb_data_path, header))
 
     def _prev_task_button_cb(self, button):
         section_index, task_index = self.get_section_and_task_index()
@@ -848,7 +1212,7 @@ class TaskMaster(Gtk.Alignment):
 
     def _progress_button_cb(self, button, i):
         section_index, task_index = self.get_section_and_task_index()
-        self.current_task += (i - task_index)
+        self.current_task = self._section_offsets[section_index] + i
         self.task_master()
 
     def _update_progress(self):
@@ -905,7 +1269,7 @@ class TaskMaster(Gtk.Alignment):
         if task_index < tasks_in_section:
             for ti in range(tasks_in_section - 1):
                 task = self._task_list[section_index]['tasks'][ti]
-                if task.is_completed():
+                if self.is_task_completed(task.uid):
                     self._progress_bar.set_button_sensitive(ti, True)
                 else:
                     self._progress_bar.set_button_sensitive(ti, False)
@@ -938,4 +1302,5 @@ class TaskMaster(Gtk.Alignment):
             '<span foreground="%s" size="%s"><b>%s</b></span>' %
             (style.COLOR_WHITE.get_html(), 'x-large',
              _('Completed: %d%%' % (completion_percentage))))
-        self.write_task_data(COMPLETION_PERCENTAGE, completion_percentage)
+        if self.read_task_data(COMPLETION_PERCENTAGE) != completion_percentage:
+            self.write_task_data(COMPLETION_PERCENTAGE, completion_percentage)
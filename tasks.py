@@ -26,8 +26,9 @@ _logger = logging.getLogger('training-activity-tasks')
 from activity import (NAME_UID, EMAIL_UID, SCHOOL_UID, ROLE_UID, SCHOOL_NAME,
                       POST_CODE)
 from graphics import Graphics, FONT_SIZES
+import schoolindex
+import taskevents
 import utils
-from reporter import Reporter
 
 # These tasks are requirements for other tasks
 _ENTER_NAME_TASK = 'enter-name-task'
@@ -64,6 +65,9 @@ GET_CONNECTED_TASK = 'get-connected-task'
 _ASSESSMENT_MIME_TYPE = 'application/vnd.ms-excel'
 _ASSESSMENT_SUFFIX = '.xls'
 
+# Search the whole list of schools once this much of a name is typed
+_SCHOOL_SEARCH_LENGTH = 3
+
 _ROLES = {
     'Teacher': [_('Teacher'), True],
     'Principal': [_('Principal'), True],
@@ -298,6 +302,11 @@ class Task():
         ''' How long should we pause between testing? '''
         return self._pause_between_checks
 
+    def get_events(self):
+        ''' Which events (see taskevents) can change the outcome of the
+            test? If None, the test is run every get_pause_time() ms. '''
+        return None
+
     def set_requires(self, requires):
         self._requires = requires[:]
 
@@ -309,6 +318,16 @@ class Task():
     requires = GObject.property(type=object, setter=set_requires,
                                 getter=get_requires)
 
+    def has_dynamic_requires(self):
+        ''' Does get_requires() depend on progress? If so, it is called
+            whenever the requirements are checked rather than once. '''
+        return False
+
+    def requirements_not_met(self):
+        ''' Called when we are about to switch from this task to one of
+            its requirements '''
+        return
+
     def is_collectable(self):
         ''' Should this task's data be collected? '''
         return False
@@ -378,8 +397,7 @@ class BadgeTask(HTMLTask):
 
     def _report_progress(self):
         _logger.debug('reporting...')
-        reporter = Reporter(self._task_master.activity)
-        reporter.report([self._task_master.read_task_data()])
+        self._task_master.send_report()
 
     def after_button_press(self):
         self._task_master.activity.mark_section_as_complete(
@@ -959,6 +977,9 @@ class Connected6Task(HTMLTask):
         self._schools = []
         self._sf_ids = []
         self._results = []
+        # (sf_id, postal code) of the schools found by searching the whole
+        # list, by name
+        self._search_results = {}
         self._default_sf_id = '0019000000pETbT'
         self._completer = None
         self._task_data = None
@@ -1016,35 +1037,16 @@ class Connected6Task(HTMLTask):
             for button in self._buttons:
                 button.destroy()
 
-            f = open(os.path.join(self._task_master.activity.bundle_path,
-                                  'schools.txt'), 'r')
-            schools = f.read().split('\n')
-            f.close()
+            school_index = schoolindex.get_index(
+                self._task_master.activity.bundle_path,
+                self._get_data_path())
+            # save the SF_ID from Sugar Labs in case we need it
+            if len(school_index.default_sf_id) > 0:
+                self._default_sf_id = school_index.default_sf_id
             self._schools = []
             self._sf_ids = []
-            for school in schools:
-                if len(school) == 0:
-                    continue
-                try:
-                    sf_id, name, campus, address, city, state, postal_code = \
-                        school.split(',')
-                except:
-                    _logger.debug('bad school data? (%s)' % school)
-                # save the SF_ID from Sugar Labs in case we need it
-                if name == 'Sugar Labs School':
-                    self._default_sf_id = sf_id
-                try:
-                    if int(postal_code) != self._postal_code:
-                        continue
-                except:
-                    _logger.error('bad postal code? (%s: %s)' %
-                                  (name, postal_code))
-                    continue
-                if len(campus) > 0:
-                    self._schools.append('%s %s, %s, %s' %
-                                         (name, campus, city, state))
-                else:
-                    self._schools.append('%s, %s, %s' % (name, city, state))
+            for name, sf_id in school_index.get_schools(self._postal_code):
+                self._schools.append(name)
                 self._sf_ids.append(sf_id)
             # _logger.debug('%d schools in the list' %  (len(self._schools)))
             self._completer = utils.Completer(self._schools)
@@ -1057,6 +1059,23 @@ class Connected6Task(HTMLTask):
         else:
             return True
 
+    def _get_data_path(self):
+        return os.path.join(self._task_master.activity.get_activity_root(),
+                            'data')
+
+    def _search_schools(self, text):
+        ''' Look for text in the whole list of schools (e.g., the postal code
+            is wrong) and return the names of the best matches. '''
+        school_search = schoolindex.get_search(
+            self._task_master.activity.bundle_path, self._get_data_path())
+        self._search_results = {}
+        names = []
+        for name, sf_id, postal_code in school_search.search(text):
+            if name not in self._search_results:
+                self._search_results[name] = (sf_id, postal_code)
+                names.append(name)
+        return names
+
     def _make_buttons(self, school_list):
         for button in self._buttons:
             button.destroy()
@@ -1092,6 +1111,15 @@ class Connected6Task(HTMLTask):
             return
         self._results = self._completer.complete(
             widget.get_text() + Gdk.keyval_name(event.keyval), 0)
+        if len(self._results) == 0:
+            text = widget.get_text()
+            keyname = Gdk.keyval_name(event.keyval)
+            if len(keyname) == 1:
+                text += keyname
+            elif keyname == 'space':
+                text += ' '
+            if len(text.strip()) >= _SCHOOL_SEARCH_LENGTH:
+                self._results = self._search_schools(text)
 
     def _yes_no_cb(self, widget, arg):
         if arg == 'yes':
@@ -1118,6 +1146,15 @@ class Connected6Task(HTMLTask):
             self._task_master.write_task_data(SCHOOL_NAME, school)
             _logger.debug('Wrote SCHOOL_UID AND SCHOOL_NAME to task_data file')
             return True
+        elif school in self._search_results:
+            # Found elsewhere in the list: the postal code was wrong.
+            sf_id, postal_code = self._search_results[school]
+            self._postal_code_entry.set_text(postal_code)
+            self._task_master.write_task_data(SCHOOL_UID, sf_id)
+            self._task_master.write_task_data(SCHOOL_NAME, school)
+            self._task_master.write_task_data(POST_CODE, postal_code)
+            _logger.debug('Wrote SCHOOL_UID AND SCHOOL_NAME to task_data file')
+            return True
         else:
             # Confirm that it is OK to use a school not in the list.
             self._task_master.task_button.hide()
@@ -1351,6 +1388,9 @@ class Activities3Task(HTMLTask):
     def get_my_turn(self):
         return True
 
+    def get_events(self):
+        return [taskevents.DATASTORE]
+
     def test(self, task_data):
         if not utils.saw_new_launch('org.laptop.RecordActivity',
                                     utils.recently(task_data['start_time'])):
@@ -1389,6 +1429,9 @@ class Activities5Task(HTMLTask):
     def get_my_turn(self):
         return True
 
+    def get_events(self):
+        return [taskevents.DATASTORE]
+
     def test(self, task_data):
         if not utils.saw_new_launch('org.laptop.AbiWordActivity',
                                     utils.recently(task_data['start_time'])):
@@ -1396,11 +1439,12 @@ class Activities5Task(HTMLTask):
         # We need the clipboard text for the Speak task
         # if not utils.is_clipboard_text_available():
         #     return False
-        paths = utils.get_odt()
-        for path in paths:
+        dsobjects = utils.get_journal_snapshot().get_by_mime_type(
+            ['application/vnd.oasis.opendocument.text'])
+        for dsobject in dsobjects:
             # Check to see if there is a picture in the file:
             # look for '\\pict' in RTF, 'Pictures' in ODT
-            if utils.find_string(path, 'Pictures'):
+            if utils.find_string_in_journal_object(dsobject, 'Pictures'):
                 return True
         return False
 
@@ -1434,6 +1478,9 @@ class Activities7Task(HTMLTask):
     def get_my_turn(self):
         return True
 
+    def get_events(self):
+        return [taskevents.DATASTORE]
+
     def test(self, task_data):
         if not utils.saw_new_launch('vu.lux.olpc.Speak',
                                     utils.recently(task_data['start_time'])):
@@ -1508,6 +1555,9 @@ class Journal3Task(HTMLTask):
     def get_my_turn(self):
         return True
 
+    def get_events(self):
+        return [taskevents.DATASTORE]
+
     def test(self, task_data):
         if task_data['data'] is None:
             activity = utils.get_most_recent_instance(
@@ -1559,6 +1609,9 @@ class Journal5Task(HTMLTask):
     def get_my_turn(self):
         return True
 
+    def get_events(self):
+        return [taskevents.DATASTORE]
+
     def test(self, task_data):
         # Make sure there are newly starred items and that the Portfolio
         # activity has been launched; then look for a PDF file.
@@ -1626,12 +1679,14 @@ class Journal7Task(HTMLTask):
     def get_my_turn(self):
         return True
 
+    def get_events(self):
+        return [taskevents.USB]
+
     def test(self, task_data):
-        paths = utils.look_for_file_type(
+        files = self._task_master.activity.usb_watcher.get_files(
             self._task_master.activity.volume_data[0]['usb_path'], '.pdf')
-        for path in paths:
-            if utils.get_modified_time(path) > \
-               utils.recently(task_data['start_time']):
+        for path in files:
+            if files[path] > utils.recently(task_data['start_time']):
                 return True
         return False
 
@@ -1840,6 +1895,9 @@ class Views5Task(HTMLTask):
         return self._task_master.activity.favorites_count
         # return len(favorites_list.keys())
 
+    def get_events(self):
+        return [taskevents.FAVORITES]
+
     def test(self, task_data):
         if not 'data' in task_data or task_data['data'] is None:
             favorites_list = utils.get_favorites()
@@ -1883,6 +1941,9 @@ class Views6Task(HTMLTask):
         return self._task_master.activity.favorites_count
         # return len(favorites_list)
 
+    def get_events(self):
+        return [taskevents.FAVORITES]
+
     def test(self, task_data):
         if not 'data' in task_data or task_data['data'] is None:
             favorites_list = utils.get_favorites()
@@ -2071,6 +2132,9 @@ class Turtle3Task(HTMLTask):
     def get_requires(self):
         return [_VALIDATE_EMAIL_TASK]
 
+    def get_events(self):
+        return [taskevents.DATASTORE]
+
     def test(self, task_data):
         if not utils.saw_new_launch('org.laptop.TurtleArtActivity',
                                     utils.recently(task_data['start_time'])):
@@ -2078,15 +2142,13 @@ class Turtle3Task(HTMLTask):
         activity = utils.get_most_recent_instance(
             'org.laptop.TurtleArtActivity')
         if activity is not None:
-            path = activity.file_path
-            if os.path.exists(path):
-                if not utils.find_string(path, 'left') and \
-                   not utils.find_string(path, 'right'):
-                    return False
-                if not utils.find_string(path, 'forward') and \
-                   not utils.find_string(path, 'back'):
-                    return False
-                return True
+            found = utils.inspect_journal_object(
+                activity, ['left', 'right', 'forward', 'back'])
+            if not 'left' in found and not 'right' in found:
+                return False
+            if not 'forward' in found and not 'back' in found:
+                return False
+            return True
         return False
 
     def get_my_turn(self):
@@ -2116,6 +2178,9 @@ class Turtle5Task(HTMLTask):
     def get_requires(self):
         return [_VALIDATE_EMAIL_TASK, _TURTLE_SQUARE_TASK]
 
+    def get_events(self):
+        return [taskevents.DATASTORE]
+
     def test(self, task_data):
         if not utils.saw_new_launch('org.laptop.TurtleArtActivity',
                                     utils.recently(task_data['start_time'])):
@@ -2123,8 +2188,7 @@ class Turtle5Task(HTMLTask):
         activity = utils.get_most_recent_instance(
             'org.laptop.TurtleArtActivity')
         if activity is not None:
-            path = activity.file_path
-            return utils.find_string(path, 'repeat')
+            return utils.find_string_in_journal_object(activity, 'repeat')
         return False
 
     def get_my_turn(self):
@@ -2154,6 +2218,9 @@ class Turtle7Task(HTMLTask):
     def get_requires(self):
         return [_VALIDATE_EMAIL_TASK, _TURTLE_SQUARE_TASK]
 
+    def get_events(self):
+        return [taskevents.DATASTORE]
+
     def test(self, task_data):
         if not utils.saw_new_launch('org.laptop.TurtleArtActivity',
                                     utils.recently(task_data['start_time'])):
@@ -2161,9 +2228,9 @@ class Turtle7Task(HTMLTask):
         activity = utils.get_most_recent_instance(
             'org.laptop.TurtleArtActivity')
         if activity is not None:
-            path = activity.file_path
-            if not utils.find_string(path, 'setpensize') and \
-               not utils.find_string(path, 'setcolor'):
+            found = utils.inspect_journal_object(
+                activity, ['setpensize', 'setcolor'])
+            if len(found) == 0:
                 return False
             return True
         return False
@@ -2195,12 +2262,14 @@ class Turtle9Task(HTMLTask):
     def get_requires(self):
         return [_VALIDATE_EMAIL_TASK, _TURTLE_SQUARE_TASK]
 
+    def get_events(self):
+        return [taskevents.DATASTORE]
+
     def test(self, task_data):
         activity = utils.get_most_recent_instance(
             'org.laptop.TurtleArtActivity')
         if activity is not None:
-            path = activity.file_path
-            if not utils.find_string(path, 'show'):
+            if not utils.find_string_in_journal_object(activity, 'show'):
                 return False
             return True
         return False
@@ -2232,12 +2301,15 @@ class Turtle11Task(HTMLTask):
     def get_requires(self):
         return [_VALIDATE_EMAIL_TASK, _TURTLE_SHOW_TASK]
 
+    def get_events(self):
+        return [taskevents.DATASTORE]
+
     def test(self, task_data):
         activity = utils.get_most_recent_instance(
             'org.laptop.TurtleArtActivity')
         if activity is not None:
-            path = activity.file_path
-            if not utils.find_string(path, 'journal'):
+            if not utils.find_string_in_journal_object(activity,
+                                                       'journal'):
                 return False
         return True
 
@@ -2268,6 +2340,9 @@ class Physics2Task(HTMLTask):
     def get_requires(self):
         return [_VALIDATE_EMAIL_TASK]
 
+    def get_events(self):
+        return [taskevents.DATASTORE]
+
     def test(self, task_data):
         return utils.saw_new_launch('org.laptop.physics',
                                     utils.recently(task_data['start_time']))
@@ -2332,6 +2407,9 @@ class Collaboration4Task(HTMLTask):
     # def is_collectable(self):
     #     return True
 
+    def get_events(self):
+        return [taskevents.DATASTORE]
+
     def test(self, task_data):
         for activity in utils.get_activity('org.laptop.physics'):
             if utils.get_share_scope(activity):
@@ -2517,6 +2595,9 @@ class XO4Task(HTMLTask):
     def get_requires(self):
         return [_VALIDATE_EMAIL_TASK]
 
+    def get_events(self):
+        return [taskevents.KEYPRESS]
+
     def test(self, task_data):
         self._task_master.grab_focus()
 
@@ -2665,8 +2746,20 @@ class Assessment1Task(HTMLTask):
             required.append(_XO_BADGE_TASK)
 
         # If the connected section is not completed, just to it.
-        if not self._task_master.uid_to_task(
-                CONNECTED_BADGE_TASK, section=None).is_completed():
+        if not self._is_connected():
+            return [CONNECTED_BADGE_TASK]
+        else:
+            return required
+
+    def has_dynamic_requires(self):
+        return True
+
+    def _is_connected(self):
+        return self._task_master.uid_to_task(
+            CONNECTED_BADGE_TASK, section=None).is_completed()
+
+    def requirements_not_met(self):
+        if not self._is_connected():
             alert = NotifyAlert()
             alert.props.title = _('Opening chapter: Getting Connected')
             alert.props.msg = _('You must complete the getting connected '
@@ -2674,9 +2767,6 @@ class Assessment1Task(HTMLTask):
             alert.connect('response',
                           self._task_master.activity.remove_alert_cb)
             self._task_master.activity.add_alert(alert)
-            return [CONNECTED_BADGE_TASK]
-        else:
-            return required
 
     def _remove_alert_cb(self, alert, response_id):
         self.remove_alert(alert)
@@ -2738,13 +2828,15 @@ class Assessment2Task(HTMLTask):
     def after_button_press(self):
         self._task_master.update_completion_percentage()
         _logger.debug('reporting...')
-        reporter = Reporter(self._task_master.activity)
-        reporter.report([self._task_master.read_task_data()])
+        self._task_master.send_report()
         return True
 
     def get_requires(self):
         return [_VALIDATE_EMAIL_TASK, _ENTER_SCHOOL_TASK]
 
+    def get_events(self):
+        return [taskevents.USB]
+
     def test(self, task_data):
         if not 'data' in task_data or task_data['data'] is None:
             task_data['data'] = '%s-%s%s' % (
@@ -2788,13 +2880,16 @@ class Assessment2Task(HTMLTask):
         else:
             # Workaround to Sugar mimetype bug that causes file copied
             # to USB has .xlw extension...
-            targets = utils.look_for_xlw(
-                self._task_master.activity.volume_data[0]['usb_path'])
+            usb_watcher = self._task_master.activity.usb_watcher
+            targets = usb_watcher.get_files(
+                self._task_master.activity.volume_data[0]['usb_path'], '.xlw')
             for target in targets:
                 utils.remove_xlw_suffix(target)
+                usb_watcher.refresh(target)
+                usb_watcher.refresh(target[:-4])
             # ...and read_only
-            targets = utils.look_for_xls(
-                self._task_master.activity.volume_data[0]['usb_path'])
+            targets = usb_watcher.get_files(
+                self._task_master.activity.volume_data[0]['usb_path'], '.xls')
             for target in targets:
                 utils.set_read_write(target)
 
@@ -0,0 +1,273 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013,14 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+''' Reading and writing training-data files
+
+The first line of a training-data file is a snapshot of the data (a JSON
+object). It is followed by an append-only log of changes, one [uid, value]
+JSON list per line. The current data are found by replaying the log over
+the snapshot. Once the log grows past COMPACT_THRESHOLD records, the file
+is rewritten as a single snapshot.
+
+Files written by earlier versions of the activity are just a snapshot, so
+they are read as is; the first append converts them to the new format.
+Older versions of the activity cannot read a file with a log.
+
+Snapshots are committed by writing a temporary file, syncing it to disk
+and renaming it over the old file, so a pulled USB key leaves either the
+old or the new file behind, never a partial one. Appended records are
+synced to disk as well; a partially written record is skipped on replay.
+
+Every commit increments the GENERATION counter stored in the data, so
+when the USB and Sugar copies disagree the newest one can be identified.
+Each key changed by a commit is stamped with that generation in the
+MODIFIED dictionary (log records carry the stamp as a third element), so
+the copies can also be reconciled key by key. Files always end with
+a GENERATION record, so the generation can be read from the tail of the
+file without parsing the snapshot.
+
+A small header file (see write_header) may be kept next to a data file so
+that the name, email address, etc. can be found without reading the data
+file. The header is only trusted if its generation matches the data file.
+'''
+
+import os
+import json
+import tempfile
+
+import logging
+_logger = logging.getLogger('training-activity-trainingdata')
+
+COMPACT_THRESHOLD = 100
+
+GENERATION = 'generation'
+MODIFIED = 'modified'
+
+HEADER_SUFFIX = '.header'
+
+# Enough of the end of a file to hold its GENERATION record
+_TAIL_SIZE = 256
+
+
+def loads(json_data):
+    ''' Returns the data and the number of log records replayed. A
+        truncated record (e.g., the USB key was pulled while we were
+        appending to it) is ignored. Raises ValueError if the snapshot
+        cannot be read. '''
+    lines = json_data.split('\n')
+    data = json.loads(lines[0])
+    if not isinstance(data, dict):
+        raise ValueError('training data is not a JSON object')
+
+    records = 0
+    for line in lines[1:]:
+        if len(line) == 0:
+            continue
+        try:
+            record = json.loads(line)
+        except ValueError:
+            record = None
+        if not isinstance(record, list) or len(record) < 2:
+            _logger.error('Ignoring bad training-data record: %s' % line)
+            continue
+        uid, value = record[0], record[1]
+        data[uid] = value
+        if len(record) > 2:
+            data.setdefault(MODIFIED, {})[uid] = record[2]
+        records += 1
+    return data, records
+
+
+def dumps(data):
+    ''' A snapshot of the data, i.e., a file without a log '''
+    return json.dumps(data)
+
+
+def dumps_snapshot(data):
+    ''' The contents of a file holding just a snapshot of the data (and
+        its generation) '''
+    contents = dumps(data)
+    if GENERATION in data:
+        contents += dumps_records({GENERATION: data[GENERATION]})
+    return contents
+
+
+def dumps_records(changes, stamps=None):
+    ''' Log records for a dictionary of changes, stamped from the stamps
+        dictionary. Each record starts with a newline so that it never ends
+        up on the same line as a record that was only partially written.
+        The generation, if present, is always the last record. '''
+    if stamps is None:
+        stamps = {}
+    records = []
+    for uid in changes:
+        if uid == GENERATION:
+            continue
+        elif uid in stamps:
+            records.append('\n' + json.dumps([uid, changes[uid],
+                                              stamps[uid]]))
+        else:
+            records.append('\n' + json.dumps([uid, changes[uid]]))
+    if GENERATION in changes:
+        records.append('\n' + json.dumps([GENERATION, changes[GENERATION]]))
+    return ''.join(records)
+
+
+def get_generation(data):
+    return data.get(GENERATION, 0)
+
+
+def next_generation(data):
+    return get_generation(data) + 1
+
+
+def apply_changes(data, changes):
+    ''' Apply a dictionary of changes to the data as a new generation,
+        stamping each changed key. The new generation is added to changes
+        so that it is logged along with them. '''
+    generation = next_generation(data)
+    stamps = data.setdefault(MODIFIED, {})
+    for uid in changes:
+        data[uid] = changes[uid]
+        stamps[uid] = generation
+    changes[GENERATION] = generation
+    data[GENERATION] = generation
+
+
+def _fsync_dir(dir_path):
+    # Not every file system lets us sync a directory; the rename has still
+    # happened, so this is not fatal.
+    try:
+        dir_fd = os.open(dir_path, os.O_RDONLY)
+        try:
+            os.fsync(dir_fd)
+        finally:
+            os.close(dir_fd)
+    except OSError, e:
+        _logger.debug('Could not sync directory %s: %s' % (dir_path, e))
+
+
+def commit(path, contents):
+    ''' Atomically replace the file at path with contents: write to a
+        temporary file in the same directory, sync it, rename it over path
+        and sync the directory. Raises IOError or OSError on failure, in
+        which case the old file is left untouched. '''
+    dir_path = os.path.dirname(path)
+    # A leading dot keeps the temporary file out of look_for_training_data
+    fd, tmp_path = tempfile.mkstemp(dir=dir_path, prefix='.training-data-',
+                                    suffix='.tmp')
+    tmp_file = os.fdopen(fd, 'w')
+    try:
+        tmp_file.write(contents)
+        tmp_file.flush()
+        os.fsync(tmp_file.fileno())
+        tmp_file.close()
+        os.rename(tmp_path, path)
+    except:
+        tmp_file.close()
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    _fsync_dir(dir_path)
+
+
+def save(path, data):
+    ''' (Re)write the file as a snapshot. '''
+    commit(path, dumps_snapshot(data))
+
+
+def read(path):
+    ''' The contents of the file at path '''
+    fd = open(path, 'r')
+    try:
+        return fd.read()
+    finally:
+        fd.close()
+
+
+def copy(src_path, dst_path):
+    ''' Commit a copy of the file at src_path to dst_path. '''
+    commit(dst_path, read(src_path))
+
+
+def append(path, changes, stamps=None):
+    ''' Append log records for a dictionary of changes to the file. '''
+    append_records(path, dumps_records(changes, stamps))
+
+
+def append_records(path, records):
+    ''' Append log records (as returned by dumps_records) to the file. '''
+    fd = open(path, 'a')
+    try:
+        fd.write(records)
+        fd.flush()
+        os.fsync(fd.fileno())
+    finally:
+        fd.close()
+
+
+def read_generation(path):
+    ''' The generation of the file at path, read from its last record, or
+        None if the file does not end with a GENERATION record. '''
+    try:
+        fd = open(path, 'r')
+        fd.seek(0, os.SEEK_END)
+        fd.seek(max(0, fd.tell() - _TAIL_SIZE))
+        tail = fd.read()
+        fd.close()
+    except IOError, e:
+        _logger.error('Could not read from %s: %s' % (path, e))
+        return None
+    try:
+        record = json.loads(tail.rsplit('\n', 1)[-1])
+    except ValueError:
+        return None
+    if isinstance(record, list) and len(record) == 2 and \
+       record[0] == GENERATION:
+        return record[1]
+    return None
+
+
+def get_header_path(path):
+    ''' The header lives in a hidden file so that it is never mistaken for
+        training data. '''
+    dir_path, file_name = os.path.split(path)
+    return os.path.join(dir_path, '.' + file_name + HEADER_SUFFIX)
+
+
+def write_header(path, header, generation):
+    ''' Save a header (a small dictionary) for the data file at path as of
+        generation. '''
+    header = dict(header)
+    header[GENERATION] = generation
+    commit(get_header_path(path), json.dumps(header))
+
+
+def read_header(path):
+    ''' The header saved for the data file at path, or None if there is
+        none or it is out of date. '''
+    header_path = get_header_path(path)
+    if not os.path.exists(header_path):
+        return None
+    try:
+        fd = open(header_path, 'r')
+        header = json.loads(fd.read())
+        fd.close()
+    except (IOError, ValueError), e:
+        _logger.error('Could not read header %s: %s' % (header_path, e))
+        return None
+    if not isinstance(header, dict) or GENERATION not in header:
+        return None
+    if read_generation(path) != header[GENERATION]:
+        return None
+    del header[GENERATION]
+    return header
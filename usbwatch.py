@@ -0,0 +1,136 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013,14 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+''' A watch on the files at the top of the USB key
+
+Globbing and stat-ing the USB key once a second is slow on flash, so the
+directory is scanned once and then kept up to date by a file monitor.
+The index holds the modification time of each (non-hidden) file, by
+suffix. Listeners are called whenever a file changes.
+'''
+
+import os
+import stat
+
+from gi.repository import Gio
+
+import logging
+_logger = logging.getLogger('training-activity-usbwatch')
+
+_UPDATE_EVENTS = [Gio.FileMonitorEvent.CREATED,
+                  Gio.FileMonitorEvent.CHANGED,
+                  Gio.FileMonitorEvent.CHANGES_DONE_HINT,
+                  Gio.FileMonitorEvent.ATTRIBUTE_CHANGED,
+                  Gio.FileMonitorEvent.DELETED,
+                  Gio.FileMonitorEvent.MOVED]
+
+
+def _get_suffix(path):
+    return os.path.splitext(path)[1]
+
+
+class USBWatcher(object):
+
+    def __init__(self):
+        self._path = None
+        self._monitor = None
+        self._index = None
+        self._listeners = []
+
+    def watch(self, path):
+        ''' Watch the directory at path (and stop watching any other). '''
+        path = os.path.normpath(path)
+        if path == self._path and self._index is not None:
+            return
+        self.stop()
+        self._path = path
+        self._scan()
+        gfile = Gio.File.new_for_path(path)
+        try:
+            self._monitor = gfile.monitor_directory(
+                Gio.FileMonitorFlags.SEND_MOVED, None)
+        except Exception, e:
+            # Without a monitor, rescan with every request.
+            _logger.error('Cannot monitor %s: %s' % (path, e))
+            return
+        self._monitor.connect('changed', self._changed_cb)
+
+    def stop(self):
+        if self._monitor is not None:
+            self._monitor.cancel()
+            self._monitor = None
+        self._path = None
+        self._index = None
+
+    def get_files(self, path, suffix):
+        ''' Returns a dictionary of the modification times of the files
+            with suffix (e.g., '.pdf') in the directory at path, by path '''
+        self.watch(path)
+        if self._monitor is None:
+            self._scan()
+        return dict(self._index.get(suffix, {}))
+
+    def refresh(self, path):
+        ''' Update the index for a file we changed ourselves (e.g., renamed)
+            without waiting for the monitor to tell us. '''
+        path = os.path.normpath(path)
+        if self._index is not None and os.path.dirname(path) == self._path:
+            self._update(path)
+
+    def add_listener(self, callback):
+        ''' callback(path) is called when a file in the watched directory
+            changes. '''
+        if callback not in self._listeners:
+            self._listeners.append(callback)
+
+    def remove_listener(self, callback):
+        if callback in self._listeners:
+            self._listeners.remove(callback)
+
+    def _scan(self):
+        self._index = {}
+        try:
+            names = os.listdir(self._path)
+        except OSError, e:
+            _logger.error('Could not list %s: %s' % (self._path, e))
+            return
+        for name in names:
+            self._update(os.path.join(self._path, name))
+
+    def _update(self, path):
+        if os.path.basename(path).startswith('.'):
+            return
+        files = self._index.setdefault(_get_suffix(path), {})
+        try:
+            stats = os.stat(path)
+        except OSError:
+            files.pop(path, None)
+            return
+        if stat.S_ISDIR(stats.st_mode):
+            return
+        files[path] = int(stats.st_mtime)
+
+    def _changed_cb(self, monitor, gfile, other_file, event_type):
+        if event_type == Gio.FileMonitorEvent.UNMOUNTED:
+            _logger.debug('%s was unmounted' % self._path)
+            self.stop()
+            return
+        if event_type not in _UPDATE_EVENTS or self._index is None:
+            return
+        paths = [gfile.get_path()]
+        if other_file is not None:
+            paths.append(other_file.get_path())
+        for path in paths:
+            if path is not None and os.path.dirname(path) == self._path:
+                self._update(path)
+                for callback in self._listeners[:]:
+                    callback(path)
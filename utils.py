@@ -13,6 +13,8 @@
 import os
 import json
 import subprocess
+import collections
+import bisect
 import dbus
 import stat
 import statvfs
@@ -24,6 +26,7 @@ import cairo
 import email.utils
 import re
 import time
+import zipfile
 
 from gi.repository import Vte
 from gi.repository import Gio
@@ -41,6 +44,9 @@ from sugar3.graphics.xocolor import XoColor
 from jarabe import config
 from jarabe.model import shell
 
+import trainingdata
+import sugarservices
+
 import logging
 _logger = logging.getLogger('training-activity-testutils')
 
@@ -67,13 +73,32 @@ _WARN_MIN_PERCENTAGE = 15
 
 _MINIMUM_SPACE = 1024 * 1024 * 10
 
-_DBUS_SERVICE = 'org.sugarlabs.SugarServices'
-_DBUS_SHELL_IFACE = 'org.sugarlabs.SugarServices'
-_DBUS_PATH = '/org/sugarlabs/SugarServices'
+# How long (in seconds) to reuse the results of a datastore query
+_DATASTORE_CACHE_TTL = 2
+# How much of a document to read at a time
+_INSPECT_CHUNK_SIZE = 64 * 1024
+# The Journal metadata used by the tests (see JournalSnapshot)
+_JOURNAL_PROPERTIES = ['uid', 'title', 'mime_type', 'activity',
+                       'activity_id', 'launch-times', 'creation_time', 'keep',
+                       'description', 'timestamp', 'share-scope',
+                       'filesize']
+# How many parsed files (see read_parsed_file) to keep
+_PARSED_FILE_CACHE_SIZE = 32
 
 volume_monitor = None
 battery_model = None
-proxy = None
+_training_data_headers = {}
+# Datastore query results (see _find), by query
+_datastore_cache = {}
+_datastore_cache_hits = 0
+_datastore_cache_misses = 0
+_datastore_signals_connected = False
+_journal_snapshot = None
+# Results of inspect_document, by path, and of inspect_journal_object,
+# by ('journal', object id)
+_document_inspections = {}
+# Results of read_parsed_file, by (path, parse), least recently used first
+_parsed_files = collections.OrderedDict()
 
 TRAINING_DATA = 'training-data-%s'
 TRAINING_SUFFIX = '.txt'
@@ -123,16 +148,8 @@ def take_screen_shot():
 
 
 def reboot():
-    global proxy
-    if proxy is None:
-        bus = dbus.SessionBus()
-        try:
-            proxy = bus.get_object(_DBUS_SERVICE, _DBUS_PATH)
-        except Exception, e:
-            _logger.error('ERROR rebooting Sugar (proxy): %s' % e)
-            _vte_reboot()
     try:
-        dbus.Interface(proxy, _DBUS_SERVICE).Reboot()
+        sugarservices.get_client().call('Reboot')
     except Exception, e:
         _logger.error('ERROR rebooting Sugar: %s' % e)
         _vte_reboot()
@@ -210,70 +227,75 @@ def look_for_training_data(path):
     return training_data
 
 
-def get_email_from_training_data(path):
+def extract_training_data_header(data):
+    ''' The name, email address, completion percentage and version number
+        found in training data '''
+    name = data.get('name', None)
+    if name is not None:
+        name = name.replace(',', ' ')
+    return {'name': name,
+            'email': data.get('email_address', None),
+            'completed': data.get('completion_percentage', None),
+            'version': data.get('version_number', None)}
+
+
+def get_training_data_header(path):
+    ''' Returns the header of a training-data file in a single pass, using
+        the header file saved alongside it if it is up to date. The results
+        are memoized by (path, mtime, size). Returns None if the file
+        cannot be read. '''
     try:
-        fd = open(path, 'r')
-        json_data = fd.read()
-        fd.close()
-    except Exception, e:
-        _logger.error('Could not read from %s: %s' % (path, e))
+        stats = os.stat(path)
+    except OSError, e:
+        _logger.error('Could not stat %s: %s' % (path, e))
         return None
-    try:
-        if len(json_data) > 0:
-            data = json.loads(json_data)
-        else:
+    stamp = (stats.st_mtime, stats.st_size)
+    if path in _training_data_headers and \
+       _training_data_headers[path][0] == stamp:
+        return _training_data_headers[path][1]
+
+    header = trainingdata.read_header(path)
+    if header is None:
+        try:
+            fd = open(path, 'r')
+            json_data = fd.read()
+            fd.close()
+        except Exception, e:
+            _logger.error('Could not read from %s: %s' % (path, e))
             return None
-    except ValueError, e:
-        _logger.error('Cannot read training data: %s' % e)
-        return None
-    if 'email_address' in data:
-        return data['email_address']
-    else:
+        try:
+            if len(json_data) > 0:
+                data = trainingdata.loads(json_data)[0]
+            else:
+                return None
+        except ValueError, e:
+            _logger.error('Cannot read training data: %s' % e)
+            return None
+        header = extract_training_data_header(data)
+
+    _training_data_headers[path] = (stamp, header)
+    return header
+
+
+def get_email_from_training_data(path):
+    header = get_training_data_header(path)
+    if header is None:
         return None
+    return header['email']
 
 
 def get_name_from_training_data(path):
-    try:
-        fd = open(path, 'r')
-        json_data = fd.read()
-        fd.close()
-    except Exception, e:
-        _logger.error('Could not read from %s: %s' % (path, e))
-        return None
-    try:
-        if len(json_data) > 0:
-            data = json.loads(json_data)
-        else:
-            return None
-    except ValueError, e:
-        _logger.error('Cannot read training data: %s' % e)
-        return None
-    if 'name' in data:
-        return data['name'].replace(',', ' ')
-    else:
+    header = get_training_data_header(path)
+    if header is None:
         return None
+    return header['name']
 
 
 def get_completed_from_training_data(path):
-    try:
-        fd = open(path, 'r')
-        json_data = fd.read()
-        fd.close()
-    except Exception, e:
-        _logger.error('Could not read from %s: %s' % (path, e))
-        return None
-    try:
-        if len(json_data) > 0:
-            data = json.loads(json_data)
-        else:
-            return None
-    except ValueError, e:
-        _logger.error('Cannot read training data: %s' % e)
-        return None
-    if 'completion_percentage' in data:
-        return data['completion_percentage']
-    else:
+    header = get_training_data_header(path)
+    if header is None:
         return None
+    return header['completed']
 
 
 def look_for_xlw(path):
@@ -550,14 +572,117 @@ def is_fullscreen(activity):
     return activity._is_fullscreen
 
 
+def _datastore_changed_cb(sender, **kwargs):
+    global _journal_snapshot
+    _datastore_cache.clear()
+    _journal_snapshot = None
+
+
+def _find(query, properties=None):
+    ''' datastore.find, reusing the results of identical queries for a
+        couple of seconds, or until a Journal entry changes '''
+    global _datastore_signals_connected, _datastore_cache_hits, \
+        _datastore_cache_misses
+    if not _datastore_signals_connected:
+        datastore.created.connect(_datastore_changed_cb)
+        datastore.updated.connect(_datastore_changed_cb)
+        datastore.deleted.connect(_datastore_changed_cb)
+        _datastore_signals_connected = True
+
+    key = json.dumps([query, properties], sort_keys=True)
+    now = time.time()
+    if key in _datastore_cache and \
+       now - _datastore_cache[key][0] < _DATASTORE_CACHE_TTL:
+        _datastore_cache_hits += 1
+    else:
+        _datastore_cache_misses += 1
+        _datastore_cache[key] = (now, datastore.find(query,
+                                                     properties=properties))
+    dsobjects, nobjects = _datastore_cache[key][1]
+    return dsobjects[:], nobjects
+
+
+def get_datastore_cache_stats():
+    ''' Returns the number of datastore queries answered from the cache
+        (hits) and from the datastore (misses) '''
+    return _datastore_cache_hits, _datastore_cache_misses
+
+
+class JournalSnapshot(object):
+    ''' The metadata of every Journal entry, fetched with a single query
+        and grouped by MIME type and activity. Only the properties in
+        _JOURNAL_PROPERTIES are fetched; the file of an entry is only
+        fetched if its file_path is used. '''
+
+    def __init__(self):
+        self.time = time.time()
+        self.entries, nentries = _find({}, properties=_JOURNAL_PROPERTIES)
+        self._by_mime_type = {}
+        self._by_activity = {}
+        for dsobject in self.entries:
+            self._by_mime_type.setdefault(
+                dsobject.metadata.get('mime_type'), []).append(dsobject)
+            self._by_activity.setdefault(
+                dsobject.metadata.get('activity'), []).append(dsobject)
+
+    def is_stale(self):
+        return time.time() - self.time >= _DATASTORE_CACHE_TTL
+
+    def get_by_mime_type(self, mime_types):
+        ''' Entries with any of the MIME types, in Journal order '''
+        if len(mime_types) == 1:
+            return self._by_mime_type.get(mime_types[0], [])[:]
+        return [dsobject for dsobject in self.entries
+                if dsobject.metadata.get('mime_type') in mime_types]
+
+    def get_by_activity(self, bundle_id):
+        return self._by_activity.get(bundle_id, [])[:]
+
+    def get_starred(self):
+        return [dsobject for dsobject in self.entries
+                if dsobject.metadata.get('keep') in ('1', 1)]
+
+
+class _FilePaths(object):
+    ''' A list of the files of Journal entries, each fetched when (and
+        only if) it is used '''
+
+    def __init__(self, dsobjects):
+        self._dsobjects = dsobjects
+
+    def __len__(self):
+        return len(self._dsobjects)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [dsobject.file_path for dsobject in self._dsobjects[i]]
+        return self._dsobjects[i].file_path
+
+    def __iter__(self):
+        for dsobject in self._dsobjects:
+            yield dsobject.file_path
+
+
+def get_journal_snapshot():
+    ''' Returns the current JournalSnapshot '''
+    global _journal_snapshot, _datastore_cache_hits
+    if _journal_snapshot is None or _journal_snapshot.is_stale():
+        _journal_snapshot = JournalSnapshot()
+    else:
+        _datastore_cache_hits += 1
+    return _journal_snapshot
+
+
+def get_files_by_mime_type(mime_types):
+    return _FilePaths(get_journal_snapshot().get_by_mime_type(mime_types))
+
+
 def get_starred():
-    dsobjects, nobjects = datastore.find({'keep': '1'})
-    return dsobjects
+    return get_journal_snapshot().get_starred()
 
 
 def get_starred_count():
-    dsobjects, nobjects = datastore.find({'keep': '1'})
-    return nobjects
+    return len(get_journal_snapshot().get_starred())
 
 
 def get_description(activity):
@@ -575,64 +700,27 @@ def get_title(activity):
 
 
 def get_sugarservices_version():
-    global proxy
-    if proxy is None:
-        bus = dbus.SessionBus()
-        try:
-            proxy = bus.get_object(_DBUS_SERVICE, _DBUS_PATH)
-        except Exception, e:
-            _logger.error('ERROR getting sugarservice service: %s' % e)
-            return 0
     try:
-        return dbus.Interface(proxy, _DBUS_SERVICE).GetVersion()
+        return sugarservices.get_client().call('GetVersion')
     except Exception, e:
         _logger.error('ERROR getting sugarservice version: %s' % e)
         return 0
 
 
 def is_activity_open(bundle_name):
-    global proxy
-    if proxy is None:
-        bus = dbus.SessionBus()
-        proxy = bus.get_object(_DBUS_SERVICE, _DBUS_PATH)
-
-    try:
-        return \
-            dbus.Interface(proxy, _DBUS_SERVICE).GetActivityName() == \
-            bundle_name and is_activity_view()
-    except Exception, e:
-        _logger.error('ERROR getting activity name %s' % e)
-        return False
+    # The name of the active activity is refreshed in the background.
+    return sugarservices.get_client().get_state('GetActivityName') == \
+        bundle_name and is_activity_view()
 
 
 def is_journal_open():
-    global proxy
-    if proxy is None:
-        bus = dbus.SessionBus()
-        proxy = bus.get_object(_DBUS_SERVICE, _DBUS_PATH)
-
-    try:
-        return dbus.Interface(proxy, _DBUS_SERVICE).IsJournal() and \
-            is_activity_view()
-    except Exception, e:
-        _logger.error('ERROR getting zoom level %s' % e)
-        return False
+    return bool(sugarservices.get_client().get_state('IsJournal')) and \
+        is_activity_view()
 
 
 def is_activity_view():
     """
-    global proxy
-    if proxy is None:
-        bus = dbus.SessionBus()
-        proxy = bus.get_object(_DBUS_SERVICE, _DBUS_PATH)
-
-    try:
-        zoom_level = \
-            dbus.Interface(proxy, _DBUS_SERVICE).GetZoomLevel()
-    except Exception, e:
-        _logger.error('ERROR getting zoom level %s' % e)
-        return False
-
+    zoom_level = sugarservices.get_client().get_state('GetZoomLevel')
     return zoom_level == shell.ShellModel.ZOOM_ACTIVITY
     """
     return True
@@ -640,18 +728,7 @@ def is_activity_view():
 
 def is_home_view():
     """
-    global proxy
-    if proxy is None:
-        bus = dbus.SessionBus()
-        proxy = bus.get_object(_DBUS_SERVICE, _DBUS_PATH)
-
-    try:
-        zoom_level = \
-            dbus.Interface(proxy, _DBUS_SERVICE).GetZoomLevel()
-    except Exception, e:
-        _logger.error('ERROR getting zoom level %s' % e)
-        return False
-
+    zoom_level = sugarservices.get_client().get_state('GetZoomLevel')
     return zoom_level == shell.ShellModel.ZOOM_HOME
     """
     return True
@@ -659,92 +736,47 @@ def is_home_view():
 
 def is_neighborhood_view():
     """
-    global proxy
-    if proxy is None:
-        bus = dbus.SessionBus()
-        proxy = bus.get_object(_DBUS_SERVICE, _DBUS_PATH)
-
-    try:
-        zoom_level = \
-            dbus.Interface(proxy, _DBUS_SERVICE).GetZoomLevel()
-    except Exception, e:
-        _logger.error('ERROR getting zoom level %s' % e)
-        return False
-
+    zoom_level = sugarservices.get_client().get_state('GetZoomLevel')
     return zoom_level == shell.ShellModel.ZOOM_MESH
     """
     return True
 
 
 def goto_activity_view():
-    global proxy
-    if proxy is None:
-        bus = dbus.SessionBus()
-        proxy = bus.get_object(_DBUS_SERVICE, _DBUS_PATH)
-
-    try:
-        dbus.Interface(proxy, _DBUS_SERVICE).SetZoomLevel(
-            shell.ShellModel.ZOOM_ACTIVITY)
-    except Exception, e:
-        _logger.error('ERROR setting zoom level %s' % e)
+    sugarservices.get_client().call_async(
+        'SetZoomLevel', (shell.ShellModel.ZOOM_ACTIVITY,))
 
 
 def goto_journal():
     ''' Actually go to the journal '''
-    global proxy
-    if proxy is None:
-        bus = dbus.SessionBus()
-        proxy = bus.get_object(_DBUS_SERVICE, _DBUS_PATH)
-    try:
-        if dbus.Interface(proxy, _DBUS_SERVICE).OpenJournal():
-            dbus.Interface(proxy, _DBUS_SERVICE).SetZoomLevel(
-                shell.ShellModel.ZOOM_ACTIVITY)
-        else:
-            _logger.error('Could not find journal to open???')
-    except Exception, e:
-        _logger.error('ERROR calling open journal: %s' % e)
+    _open_journal(shell.ShellModel.ZOOM_ACTIVITY)
 
 
 def set_journal_active():
     ''' Just set the Journal as the active activity in the Home View '''
-    global proxy
-    if proxy is None:
-        bus = dbus.SessionBus()
-        proxy = bus.get_object(_DBUS_SERVICE, _DBUS_PATH)
-    try:
-        if dbus.Interface(proxy, _DBUS_SERVICE).OpenJournal():
-            dbus.Interface(proxy, _DBUS_SERVICE).SetZoomLevel(
-                shell.ShellModel.ZOOM_HOME)
+    _open_journal(shell.ShellModel.ZOOM_HOME)
+
+
+def _open_journal(zoom_level):
+    client = sugarservices.get_client()
+
+    def reply_handler(opened):
+        if opened:
+            client.call_async('SetZoomLevel', (zoom_level,))
         else:
             _logger.error('Could not find journal to open???')
-    except Exception, e:
-        _logger.error('ERROR calling open journal: %s' % e)
 
+    client.call_async('OpenJournal', reply_handler=reply_handler)
 
-def goto_home_view():
-    global proxy
-    if proxy is None:
-        bus = dbus.SessionBus()
-        proxy = bus.get_object(_DBUS_SERVICE, _DBUS_PATH)
 
-    try:
-        dbus.Interface(proxy, _DBUS_SERVICE).SetZoomLevel(
-            shell.ShellModel.ZOOM_HOME)
-    except Exception, e:
-        _logger.error('ERROR setting zoom level %s' % e)
+def goto_home_view():
+    sugarservices.get_client().call_async(
+        'SetZoomLevel', (shell.ShellModel.ZOOM_HOME,))
 
 
 def goto_neighborhood_view():
-    global proxy
-    if proxy is None:
-        bus = dbus.SessionBus()
-        proxy = bus.get_object(_DBUS_SERVICE, _DBUS_PATH)
-
-    try:
-        dbus.Interface(proxy, _DBUS_SERVICE).SetZoomLevel(
-            shell.ShellModel.ZOOM_MESH)
-    except Exception, e:
-        _logger.error('ERROR setting zoom level %s' % e)
+    sugarservices.get_client().call_async(
+        'SetZoomLevel', (shell.ShellModel.ZOOM_MESH,))
 
 
 def get_share_scope(activity):
@@ -804,21 +836,64 @@ def get_nick():
     return profile.get_nick_name()
 
 
+def read_parsed_file(path, parse):
+    ''' Returns parse(contents) for the file at path. The results are
+        memoized by (path, mtime, size), so the file is only read and parsed
+        again once it changes; the most recently used files are kept. The
+        result is shared between callers, so it must not be modified.
+        Raises OSError or IOError if the file cannot be read, and whatever
+        parse raises. '''
+    stats = os.stat(path)
+    return _read_parsed((path, parse), (stats.st_mtime, stats.st_size),
+                        lambda: path, parse)
+
+
+def read_parsed_journal_object(dsobject, parse):
+    ''' Like read_parsed_file, for the file of a Journal entry (memoized
+        by uid, timestamp and file size, as in inspect_journal_object). '''
+    stamp = (dsobject.metadata.get('timestamp'),
+             dsobject.metadata.get('filesize'))
+    return _read_parsed(('journal', dsobject.object_id, parse), stamp,
+                        lambda: dsobject.file_path, parse)
+
+
+def _read_parsed(key, stamp, get_path, parse):
+    if key in _parsed_files:
+        entry = _parsed_files.pop(key)
+        if entry[0] == stamp:
+            _parsed_files[key] = entry
+            return entry[1]
+
+    path = get_path()
+    fd = open(path, 'r')
+    try:
+        contents = fd.read()
+    finally:
+        fd.close()
+    value = parse(contents)
+    _parsed_files[key] = (stamp, value)
+    while len(_parsed_files) > _PARSED_FILE_CACHE_SIZE:
+        _parsed_files.popitem(last=False)
+    return value
+
+
+def _parse_favorites(contents):
+    return json.loads(contents)['favorites']
+
+
 def get_favorites():
     favorites_path = env.get_profile_path('favorite_activities')
-    if os.path.exists(favorites_path):
-        favorites_data = json.load(open(favorites_path))
-        favorites_list = favorites_data['favorites']
-    return favorites_list
+    if not os.path.exists(favorites_path):
+        return {}
+    return read_parsed_file(favorites_path, _parse_favorites)
 
 
 def get_activity(bundle_id):
-    dsobjects, nobjects = datastore.find({'activity': [bundle_id]})
-    return dsobjects
+    return get_journal_snapshot().get_by_activity(bundle_id)
 
 
 def get_most_recent_instance(bundle_id):
-    dsobjects, nobjects = datastore.find({'activity': [bundle_id]})
+    dsobjects = get_journal_snapshot().get_by_activity(bundle_id)
     most_recent_time = -1
     most_recent_instance = None
     for activity in dsobjects:
@@ -830,70 +905,43 @@ def get_most_recent_instance(bundle_id):
 
 
 def get_audio():
-    paths = []
-    dsobjects, nobjects = datastore.find({'mime_type': ['audio/ogg']})
-    for dsobject in dsobjects:
-        paths.append(dsobject.file_path)
-    return paths
+    return get_files_by_mime_type(['audio/ogg'])
 
 
 def get_image():
-    paths = []
-    dsobjects, nobjects = datastore.find({'mime_type': ['image/png',
-                                                        'image/jpeg']})
-    for dsobject in dsobjects:
-        paths.append(dsobject.file_path)
-    return paths
+    return get_files_by_mime_type(['image/png', 'image/jpeg'])
 
 
 def get_png():
-    paths = []
-    dsobjects, nobjects = datastore.find({'mime_type': ['image/png']})
-    for dsobject in dsobjects:
-        paths.append(dsobject.file_path)
-    return paths
+    return get_files_by_mime_type(['image/png'])
 
 
 def get_jpg():
-    paths = []
-    dsobjects, nobjects = datastore.find({'mime_type': ['image/jpeg']})
-    for dsobject in dsobjects:
-        paths.append(dsobject.file_path)
-    return paths
+    return get_files_by_mime_type(['image/jpeg'])
 
 
 def get_rtf():
-    dsobjects, nobjects = datastore.find({'mime_type': ['text/rtf',
-                                                        'application/rtf']})
-    paths = []
-    for dsobject in dsobjects:
-        paths.append(dsobject.file_path)
-    return paths
+    return get_files_by_mime_type(['text/rtf', 'application/rtf'])
 
 
 def get_pdf():
-    dsobjects, nobjects = datastore.find({'mime_type': ['application/pdf']})
-    paths = []
-    for dsobject in dsobjects:
-        paths.append(dsobject.file_path)
-    return paths
+    return get_files_by_mime_type(['application/pdf'])
 
 
 def get_odt():
-    dsobjects, nobjects = datastore.find(
-        {'mime_type':
-         ['application/vnd.oasis.opendocument.text']})
-    paths = []
-    for dsobject in dsobjects:
-        paths.append(dsobject.file_path)
-    return paths
+    return get_files_by_mime_type(['application/vnd.oasis.opendocument.text'])
+
+
+def _parse_speak_settings(contents):
+    configuration = json.loads(contents)
+    return json.loads(configuration['status'])
 
 
 def get_speak_settings(activity):
-    file_path = activity.file_path
+    if activity is None:
+        return None
     try:
-        configuration = json.loads(file(file_path, 'r').read())
-        status = json.loads(configuration['status'])
+        status = read_parsed_journal_object(activity, _parse_speak_settings)
     except Exception:
         # Ignore: Speak activity has not yet written out its data.
         return None
@@ -901,12 +949,8 @@ def get_speak_settings(activity):
 
 
 def uitree_dump():
-    global proxy
-    if proxy is None:
-        bus = dbus.SessionBus()
-        proxy = bus.get_object(_DBUS_SERVICE, _DBUS_PATH)
     try:
-        return json.loads(dbus.Interface(proxy, _DBUS_SERVICE).Dump())
+        return json.loads(sugarservices.get_client().call('Dump'))
     except Exception, e:
         print ('ERROR calling Dump: %s' % e)
         # _logger.error('ERROR calling Dump: %s' % e)
@@ -914,24 +958,16 @@ def uitree_dump():
 
 
 def get_uitree_node(name):
-    global proxy
-    if proxy is None:
-        bus = dbus.SessionBus()
-        proxy = bus.get_object(_DBUS_SERVICE, _DBUS_PATH)
     try:
-        return dbus.Interface(proxy, _DBUS_SERVICE).FindChild(name)
+        return sugarservices.get_client().call('FindChild', name)
     except Exception, e:
         _logger.error('ERROR calling FindChild: %s' % e)
     return False
 
 
 def click_uitree_node(name):
-    global proxy
-    if proxy is None:
-        bus = dbus.SessionBus()
-        proxy = bus.get_object(_DBUS_SERVICE, _DBUS_PATH)
     try:
-        return dbus.Interface(proxy, _DBUS_SERVICE).Click(name)
+        return sugarservices.get_client().call('Click', name)
     except Exception, e:
         _logger.error('ERROR calling Click: %s' % e)
     return False
@@ -950,15 +986,89 @@ def select_favorites_view():
 
 
 def find_string(path, string):
+    return string in inspect_document(path, [string])
+
+
+def find_string_in_journal_object(dsobject, string):
+    return string in inspect_journal_object(dsobject, [string])
+
+
+def _scan_document(path, patterns):
+    ''' Returns the patterns found in the document at path. For a zip
+        archive (e.g., an ODT file), we look for the patterns in the names
+        of the archived files (e.g., 'Pictures/...'). '''
+    found = set()
+    if zipfile.is_zipfile(path):
+        archive = zipfile.ZipFile(path)
+        names = archive.namelist()
+        archive.close()
+        for pattern in patterns:
+            for name in names:
+                if pattern in name:
+                    found.add(pattern)
+                    break
+        return found
+
+    # Keep enough of each chunk to find patterns that span two chunks.
+    overlap = max([len(pattern) for pattern in patterns]) - 1
+    tail = ''
+    fd = open(path, 'rb')
     try:
-        fd = open(path, 'r')
-    except Exception as e:
-        # _logger.error('Could not open file at %s: %s' % (path, e))
-        return False
-    for line in fd:
-        if string in line:
-            return True
-    return False
+        while len(found) < len(patterns):
+            chunk = fd.read(_INSPECT_CHUNK_SIZE)
+            if len(chunk) == 0:
+                break
+            text = tail + chunk
+            for pattern in patterns:
+                if pattern in text:
+                    found.add(pattern)
+            if overlap > 0:
+                tail = text[-overlap:]
+    finally:
+        fd.close()
+    return found
+
+
+def inspect_document(path, patterns):
+    ''' Returns the set of patterns found in the document at path, in a
+        single pass. The results are memoized by (path, mtime, size), so an
+        unchanged document is never read twice for the same pattern. '''
+    try:
+        stats = os.stat(path)
+    except (OSError, TypeError):
+        return set()
+    return _inspect(path, (stats.st_mtime, stats.st_size), lambda: path,
+                    patterns)
+
+
+def inspect_journal_object(dsobject, patterns):
+    ''' Like inspect_document, for the file of a Journal entry. Each use of
+        file_path makes a new temporary copy of the file, so the results
+        are memoized by the entry's uid, timestamp and file size instead,
+        and the file is only fetched if the entry has changed. '''
+    stamp = (dsobject.metadata.get('timestamp'),
+             dsobject.metadata.get('filesize'))
+    return _inspect(('journal', dsobject.object_id), stamp,
+                    lambda: dsobject.file_path, patterns)
+
+
+def _inspect(key, stamp, get_path, patterns):
+    if key not in _document_inspections or \
+       _document_inspections[key][0] != stamp:
+        _document_inspections[key] = (stamp, {})
+    results = _document_inspections[key][1]
+
+    missing = [pattern for pattern in patterns if pattern not in results]
+    if len(missing) > 0:
+        path = get_path()
+        try:
+            found = _scan_document(path, missing)
+        except (IOError, TypeError, zipfile.BadZipfile), e:
+            _logger.error('Could not inspect %s: %s' % (path, e))
+            return set()
+        for pattern in missing:
+            results[pattern] = pattern in found
+    return set([pattern for pattern in patterns if results[pattern]])
 
 
 class DeviceModel(GObject.GObject):
@@ -1040,13 +1150,8 @@ class DeviceModel(GObject.GObject):
 
 
 def nm_status():
-    global proxy
-    if proxy is None:
-        bus = dbus.SessionBus()
-        proxy = bus.get_object(_DBUS_SERVICE, _DBUS_PATH)
-
     try:
-        status = dbus.Interface(proxy, _DBUS_SERVICE).NMStatus()
+        status = sugarservices.get_client().call('NMStatus')
         logging.debug(status)
     except Exception, e:
         _logger.error('ERROR getting NM Status: %s' % e)
@@ -1065,20 +1170,67 @@ def nm_status():
         return 'unknown'
 
 
+class _Matches(object):
+    ''' A view of the options[start:stop] of a Completer, without a copy '''
+
+    def __init__(self, options, start, stop):
+        self._options = options
+        self._start = start
+        self._stop = stop
+
+    def __len__(self):
+        return self._stop - self._start
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self._options[j]
+                    for j in range(self._start, self._stop)[i]]
+        if i < 0:
+            i += len(self)
+        if i < 0 or i >= len(self):
+            raise IndexError('match index out of range')
+        return self._options[self._start + i]
+
+    def __iter__(self):
+        for i in range(self._start, self._stop):
+            yield self._options[i]
+
+
 class Completer(object):
+    ''' The options are sorted once by their lower-case keys, so the options
+        that start with some text are found by a binary search. As the user
+        types on, each search starts from the matches for the previous
+        text. '''
 
     def __init__(self, options):
-        self.options = sorted(options)
+        options = sorted([(s.lower(), s) for s in options if s])
+        self._keys = [key for key, s in options]
+        self.options = [s for key, s in options]
+        self._prefix = ''
+        self._start = 0
+        self._stop = len(self.options)
+        self.matches = _Matches(self.options, self._start, self._stop)
+
+    def _search(self, prefix):
+        if prefix.startswith(self._prefix):
+            start, stop = self._start, self._stop
+        else:
+            start, stop = 0, len(self._keys)
+        start = bisect.bisect_left(self._keys, prefix, start, stop)
+        # The keys that start with prefix come before any key that is
+        # greater than prefix when cut to its length.
+        end = start
+        while end < stop:
+            middle = (end + stop) // 2
+            if self._keys[middle][:len(prefix)] == prefix:
+                end = middle + 1
+            else:
+                stop = middle
+        self._prefix = prefix
+        self._start, self._stop = start, end
 
     def complete(self, text, state):
-        if state == 0:  # on first trigger, build possible matches
-            if text:  # cache matches (entries that start with entered text)
-                self.matches = [s for s in self.options
-                                if s and s.lower().startswith(text.lower())]
-            else:  # no text entered, all matches possible
-                self.matches = self.options[:]
-
-        try:
-            return self.matches
-        except IndexError:
-            return None
+        if state == 0:  # on first trigger, find possible matches
+            self._search(text.lower())
+            self.matches = _Matches(self.options, self._start, self._stop)
+        return self.matches
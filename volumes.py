@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+# Copyright (c) 2013,14 Walter Bender
+
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation; either version 3 of the License, or
+# (at your option) any later version.
+#
+# You should have received a copy of the GNU General Public License
+# along with this library; if not, write to the Free Software
+# Foundation, 51 Franklin Street, Suite 500 Boston, MA 02110-1335 USA
+
+''' A registry of the mounted volumes and the training-data files on them
+
+Scanning the volumes (globbing for training data, etc.) is slow on a USB
+key, so the results are kept until a mount is added or removed. The
+serial number is incremented whenever the registry changes, so callers
+can tell whether anything they derived from it is still valid.
+'''
+
+import os
+
+import utils
+
+import logging
+_logger = logging.getLogger('training-activity-volumes')
+
+
+class VolumeRegistry(object):
+
+    def __init__(self):
+        self.serial = 0
+        self._volumes = None
+
+    def _scan(self):
+        self._volumes = []
+        for path in utils.get_volume_paths():
+            self._volumes.append({'basename': os.path.basename(path),
+                                  'files': utils.look_for_training_data(path),
+                                  'usb_path': path})
+        _logger.debug('scanned volumes: %s' % self._volumes)
+
+    def get_volumes(self):
+        ''' Returns a list of dictionaries (basename, files, usb_path), one
+            per mounted volume; the caller may add keys of its own. '''
+        if self._volumes is None:
+            self._scan()
+        return self._volumes
+
+    def rescan_files(self, path):
+        ''' Look for training data again (e.g., after files were renamed)
+            on the volume mounted at path and return the file list. '''
+        files = utils.look_for_training_data(path)
+        for volume in self.get_volumes():
+            if volume['usb_path'] == path:
+                volume['files'] = files
+        return files
+
+    def invalidate(self):
+        ''' The mounts have changed: rescan with the next request. '''
+        self._volumes = None
+        self.serial += 1